@@ -1,15 +1,31 @@
 import os
-from openai import OpenAI
+import asyncio
+import openai
+from openai import OpenAI, AsyncOpenAI
 from dotenv import load_dotenv
-from pydantic import BaseModel
-from typing import List, Optional
-import json
+from pydantic import BaseModel, ValidationError
+from typing import List, Literal, Optional
+from functools import lru_cache
+import orjson
+import queue
+import hashlib
+import httpx
+import io
+import re
+import shlex
+import tarfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from string import Template
 from e2b_code_interpreter import Sandbox
 import logging
-import traceback
 import sys
 from datetime import datetime
 from langsmith.wrappers import wrap_openai
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_random_exponential
+
+from cache_utils import CACHE_DISABLED, get_cache_key, get_bundle_key, read_cached_response, write_cached_response, read_semantic_cache, write_semantic_cache
 
 
 load_dotenv()
@@ -17,144 +33,543 @@ load_dotenv()
 # Configure API keys and tokens
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 
-# client = OpenAI(api_key=OPENAI_API_KEY)
-client = wrap_openai(OpenAI(api_key=OPENAI_API_KEY))
+@lru_cache(maxsize=1)
+def _get_client():
+    """Create the shared OpenAI client on first use."""
+    # Retries are handled by llm_retry, the SDK's own would stack on top of them
+    return wrap_openai(OpenAI(api_key=OPENAI_API_KEY, max_retries=0))
+
+@lru_cache(maxsize=1)
+def _get_async_client():
+    """Create the shared async OpenAI client on first use; it must only be used on the run_async loop."""
+    # Keep connections alive so concurrent requests and later builds reuse them instead of opening new ones
+    return wrap_openai(AsyncOpenAI(api_key=OPENAI_API_KEY, max_retries=0, http_client=openai.DefaultAsyncHttpxClient(limits=OPENAI_HTTP_LIMITS)))
+
+_event_loop = None
+_event_loop_lock = threading.Lock()
+
+def _get_event_loop():
+    """Start the process-wide background event loop on first use and return it."""
+    global _event_loop
+    with _event_loop_lock:
+        if _event_loop is None:
+            _event_loop = asyncio.new_event_loop()
+            _event_loop.set_default_executor(ThreadPoolExecutor(max_workers=ASYNC_THREAD_WORKERS))
+            threading.Thread(target=_event_loop.run_forever, name="deploybot-async", daemon=True).start()
+    return _event_loop
+
+def run_async(coroutine):
+    """Run a coroutine on the process-wide background event loop and return its result."""
+    return asyncio.run_coroutine_threadsafe(coroutine, _get_event_loop()).result()
 
 # Set up logging
 log_directory = "logs"
-os.makedirs(log_directory, exist_ok=True)
-log_filename = os.path.join(log_directory, f"website_builder_{datetime.now().strftime('%Y%m%d_%H%M%S')}.log")
-
-# Configure root logger
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler(log_filename),
-        logging.StreamHandler(sys.stdout)
-    ]
-)
+
+@lru_cache(maxsize=1)
+def _init_logging():
+    """Configure file and console logging on first use instead of at import."""
+    os.makedirs(log_directory, exist_ok=True)
+    log_filename = os.path.join(log_directory, f"website_builder_{datetime.now().strftime('%Y%m%d_%H%M%S')}.log")
+    
+    # Configure root logger
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        handlers=[
+            # delay opens the log file on the first record
+            logging.FileHandler(log_filename, delay=True),
+            logging.StreamHandler(sys.stdout)
+        ]
+    )
 
 # Create logger for this module
 logger = logging.getLogger('website_builder')
 
-class FileDescription(BaseModel):
-    file_name: str
-    description: str
-    importance: Optional[int] = None  # For ranking files by importance
+# Maximum number of OpenAI requests in flight while generating files concurrently,
+# lower it to stay under the account's RPM/TPM limits
+MAX_CONCURRENT_GENERATIONS = int(os.getenv("DEPLOYBOT_MAX_CONCURRENT_GENERATIONS", "10"))
 
-def define_website_structure(website_description):
-    """Use OpenAI to define the file structure for the website based on description."""
-    try:
-        system_prompt = {"role": "system", "content": "You are a helpful assistant."}
-        message_list = [system_prompt]
-        
-        user_prompt = f"""
+# Models used for generation: the stronger model where code quality matters,
+# the cheaper one for planning and simple files
+CODE_MODEL = "gpt-4o"
+LIGHT_MODEL = "gpt-4o-mini"
+
+# Model per task, keyed by task name, file name or file extension
+MODEL_MAP = {
+    "structure": LIGHT_MODEL,
+    "regenerate": CODE_MODEL,
+    "batch": CODE_MODEL,
+    "requirements.txt": LIGHT_MODEL,
+    "README.md": LIGHT_MODEL,
+    ".css": LIGHT_MODEL,
+    ".js": LIGHT_MODEL,
+    "default": CODE_MODEL
+}
+
+# Output token cap per task, keyed the same way as MODEL_MAP, so a runaway response stays bounded
+MAX_TOKENS = {
+    "structure": 1500,
+    "requirements.txt": 200,
+    "app.py": 2500,
+    ".html": 3000,
+    ".css": 3000,
+    ".js": 3000,
+    "patch": 1000,
+    "default": 4000
+}
+
+# A file cut off at its cap is generated once more with the cap multiplied by this
+TRUNCATED_RETRY_FACTOR = 2
+
+# Number of tasks writing generated files to the sandbox
+MAX_SANDBOX_WRITERS = 4
+
+# Fixed sampling seed for best-effort deterministic completions; it is also part of every cache key
+OPENAI_SEED = 42
+
+# Semantic cache: responses are reused for prompts whose embeddings are this similar
+EMBEDDING_MODEL = "text-embedding-3-small"
+SEMANTIC_CACHE_THRESHOLD = 0.92
+# Files where a near miss breaks the site only reuse exact matches, which skips the semantic lookup
+SEMANTIC_CACHE_THRESHOLDS = {
+    "app.py": 1.0,
+    "requirements.txt": 1.0,
+    "default": SEMANTIC_CACHE_THRESHOLD
+}
+SEMANTIC_CACHE_TTL = 7*24*60*60  # seconds
+
+# Transient OpenAI errors that are retried with exponential backoff
+RETRYABLE_OPENAI_ERRORS = (openai.RateLimitError, openai.APIConnectionError, openai.InternalServerError)
+LLM_MAX_ATTEMPTS = 3
+# Longest wait honored from a Retry-After header, so one rate limit can't block a request for long
+LLM_MAX_RETRY_AFTER = 30  # seconds
+
+# Readiness probe for servers started in the sandbox, polled inside the sandbox with exponential backoff
+READINESS_TIMEOUT = 10  # seconds
+READINESS_INITIAL_DELAY = 0.05  # seconds before the second probe
+READINESS_MAX_DELAY = 0.5  # seconds between probes at most
+READY_STATUS_CODES = ("200", "301", "302", "404")
+
+# How much of the end of a failed server's log is sent along when asking for a fix
+ERROR_LOG_TAIL_CHARS = 4000
+# Parts of server log lines that change between attempts at the same failure (gunicorn's
+# "[timestamp] [pid]" prefix, worker pids, the Flask debugger PIN), removed so the failure keeps one key
+VOLATILE_LOG_PATTERNS = (
+    re.compile(r"^\[\d{4}-\d{2}-\d{2} [^\]]*\] \[\d+\] ", re.MULTILINE),
+    re.compile(r"(?<=pid: )\d+"),
+    re.compile(r"(?<=Debugger PIN: )[\d-]+")
+)
+
+# Diagnostics collected by check_sandbox_logs, as (title, command) pairs
+DIAGNOSTIC_COMMANDS = [
+    ("Log files content", "find /home/user -name '*.log' -type f -exec cat {} \\; 2>/dev/null || echo 'No log files found'"),
+    ("Running processes", "ps aux"),
+    ("System logs", "dmesg | tail -n 50"),
+    ("Traceback files", "find /home/user -name '*.err' -o -name '*.traceback' -type f -exec cat {} \\; 2>/dev/null || echo 'No error files found'"),
+    ("Flask error traceback", "cd /home/user && python -c 'import traceback; print(traceback.format_exc())' 2>/dev/null || echo 'No Python traceback available'")
+]
+DIAGNOSTIC_MARKER = "===DEPLOYBOT DIAGNOSTIC "
+
+# Batch API polling configuration (in seconds)
+BATCH_POLL_INTERVAL = 15
+BATCH_TIMEOUT = 30*60
+
+# System prompt shared by every code generation request
+CODE_SYSTEM_PROMPT = {
+    "role": "system",
+    "content": "You are a code generation assistant. ALWAYS output ONLY valid, runnable code. DO NOT include explanations, markdown formatting, backticks, or extra text. No introductions, summaries, or additional commentary."
+}
+
+# Prompt for planning the site's files
+_STRUCTURE_TMPL = Template("""
         Please write the simplest flask app that will meet the requirements of the following description.
         The website should be visually appealing and easy to use.
         DESCRIPTION:
-        {website_description}
+        $website_description
 
-        Output the directory structure of the app. It should be a list of files and a description of the contents of each file.
+        Output the directory structure of the app. It should be a list of files with a description of the contents of each file,
+        and an importance rank for each file, with 1 being the most important.
         EXAMPLE:
-        [
-        {{
+        {
+        "files": [
+        {
             "file_name": "app.py",
-            "description": "This is the main file that will run the app."
-        }},
-        {{
+            "description": "This is the main file that will run the app.",
+            "importance": 1
+        },
+        {
             "file_name": "requirements.txt", 
-            "description": "This is the requirements file for the app."
-        }},
-        {{
-            "file_name": "README.md",
-            "description": "This is the README file for the app."
-        }},
-        {{
+            "description": "This is the requirements file for the app.",
+            "importance": 2
+        },
+        {
             "file_name": "templates/index.html",
-            "description": "This is the template for the index page of the app."
-        }},
-        {{
+            "description": "This is the template for the index page of the app.",
+            "importance": 3
+        },
+        {
             "file_name": "static/style.css",
-            "description": "This is the CSS file for the app."
-        }},
-        {{
+            "description": "This is the CSS file for the app.",
+            "importance": 4
+        },
+        {
             "file_name": "static/script.js",
-            "description": "This is the JavaScript file for the app."
-        }}
+            "description": "This is the JavaScript file for the app.",
+            "importance": 5
+        },
+        {
+            "file_name": "README.md",
+            "description": "This is the README file for the app.",
+            "importance": 6
+        }
         ]
+        }
 
         Do not include any other text. Do not include any markdown, code blocks, or explanations.
         OUTPUT:
-        """
+        """)
+# Structures cached for similar descriptions are only reused with the same prompt
+STRUCTURE_PROMPT_HASH = hashlib.sha1(_STRUCTURE_TMPL.template.encode("utf-8")).hexdigest()
+
+# Prompt templates for generating a single file. The website description and project structure
+# come first and the target file last, so every file request in a run shares the longest possible
+# prefix for OpenAI prompt caching
+_APP_PY_TMPL = Template("""
+        I'm building a web application with the following description:
+        $website_description
         
-        message_list.append({"role": "user", "content": user_prompt})
+        $project_structure
+        ---
+        TARGET FILE: $file_name
+        $description
         
-        completion = client.chat.completions.create(
-            model="gpt-4o",
-            messages=message_list
-        )
+        IMPORTANT CONSTRAINTS:
+        1. Make sure the Flask app is properly configured to run on all interfaces (0.0.0.0)
+        2. Set debug=True during development
+        3. Include error handlers for common HTTP errors
+        4. Wrap route handlers in try/except blocks to prevent unhandled exceptions
+        
+        ALWAYS output ONLY valid, runnable code. DO NOT include explanations, markdown formatting, backticks, or extra text. No introductions, summaries, or additional commentary.
+        """)
+
+_REQS_TMPL = Template("""
+        I'm building a web application with the following description:
+        $website_description
+        
+        $project_structure
+        ---
+        TARGET FILE: $file_name
+        $description
+        
+        IMPORTANT CONSTRAINTS:
+        1. Include only the absolute minimum required dependencies
+        2. DO NOT include version numbers for any package
+        3. Each dependency should be on its own line with no version constraints
+        4. Include only well-established, widely-used packages
+        5. Ensure necessary dependencies are included for the app to run such as flask, gunicorn, etc.
+        
+        ALWAYS output ONLY valid, runnable code. DO NOT include explanations, markdown formatting, backticks, or extra text. No introductions, summaries, or additional commentary.
+        """)
+
+_GENERIC_TMPL = Template("""
+        I'm building a web application with the following description:
+        $website_description
+        
+        $project_structure
+        ---
+        TARGET FILE: $file_name
+        $description
+        
+        ALWAYS output ONLY valid, runnable code. DO NOT include explanations, markdown formatting, backticks, or extra text. No introductions, summaries, or additional commentary.
+        """)
+
+# Files with dedicated constraints: app.py must bind to all interfaces, requirements.txt stays minimal
+FILE_PROMPT_TEMPLATES = {
+    "app.py": _APP_PY_TMPL,
+    "requirements.txt": _REQS_TMPL
+}
+
+# Cached site bundles are only reused by the same generator: models, token caps and prompts are hashed in,
+# bump SITE_BUNDLE_REVISION when something else that shapes the generated files changes
+SITE_BUNDLE_REVISION = 1
+SITE_BUNDLE_VERSION = hashlib.sha256(orjson.dumps([
+    SITE_BUNDLE_REVISION,
+    MODEL_MAP,
+    MAX_TOKENS,
+    CODE_SYSTEM_PROMPT,
+    _STRUCTURE_TMPL.template,
+    _GENERIC_TMPL.template,
+    {file_name: template.template for file_name, template in FILE_PROMPT_TEMPLATES.items()}
+])).hexdigest()
+# Files the run step may rewrite while fixing the server, re-read before a bundle is cached
+RUN_MODIFIED_FILES = ("app.py", "requirements.txt")
+
+# Sandboxes are kept alive for an hour, idle ones are pooled and reused across builds
+SANDBOX_TIMEOUT = 60*60
+# Custom e2b template with the Flask stack pre-installed (see e2b.Dockerfile), the default image when unset
+SANDBOX_TEMPLATE = os.getenv("DEPLOYBOT_SANDBOX_TEMPLATE")
+SANDBOX_POOL_SIZE = 4
+_sandbox_pool = queue.Queue(maxsize=SANDBOX_POOL_SIZE)
+
+# Async build stages of every request run on one background event loop (see run_async), so the async
+# OpenAI client's connections are shared across builds; blocking steps run on this many threads
+ASYNC_THREAD_WORKERS = 32
+# Connection limits for the async OpenAI client used during concurrent generation
+OPENAI_HTTP_LIMITS = httpx.Limits(max_connections=MAX_CONCURRENT_GENERATIONS * 2, max_keepalive_connections=20)
+
+# Packages are installed with uv, bootstrapped with pip when the sandbox does not have it yet.
+# uv's wheel cache lives in ~/.cache/uv, which survives sandbox reuse because release only clears visible files
+PIP_INSTALL = "(command -v uv >/dev/null 2>&1 || pip install --prefer-binary --disable-pip-version-check uv) && uv pip install --system"
+
+# pip and uv errors naming the requirement that could not be installed
+PIP_UNRESOLVED_PATTERNS = (
+    re.compile(r"No matching distribution found for (\S+)"),
+    re.compile(r"Could not find a version that satisfies the requirement (\S+)"),
+    re.compile(r"Because (\S+) was not found in the package registry"),
+    re.compile(r"Because there is no version of (\S+)")
+)
+MISSING_MODULE_PATTERN = re.compile(r"ModuleNotFoundError: No module named '([\w.]+)'")
+# Modules whose PyPI package has a different name
+MODULE_PACKAGE_NAMES = {
+    "bs4": "beautifulsoup4",
+    "cv2": "opencv-python",
+    "dateutil": "python-dateutil",
+    "dotenv": "python-dotenv",
+    "PIL": "pillow",
+    "sklearn": "scikit-learn",
+    "yaml": "pyyaml"
+}
+# Third-party modules a missing import may be installed for; anything else is assumed to be one of
+# the site's own modules (e.g. a models.py that failed to generate) and is never installed from PyPI
+KNOWN_PACKAGE_MODULES = set(MODULE_PACKAGE_NAMES) | {
+    "bcrypt", "bleach", "email_validator", "flask", "flask_bcrypt", "flask_caching", "flask_cors",
+    "flask_limiter", "flask_login", "flask_mail", "flask_migrate", "flask_session", "flask_sqlalchemy",
+    "flask_wtf", "gunicorn", "itsdangerous", "jinja2", "markdown", "markupsafe", "numpy", "pandas",
+    "pytz", "requests", "sqlalchemy", "werkzeug", "wtforms"
+}
+
+# Fixes already requested for a file, keyed by sandbox, file name and error message hash
+_regen_cache = {}
+
+# Freshly generated sites waiting for a successful run before they are cached, keyed by sandbox ID
+_pending_bundles = {}
+
+# Rank given to files the model did not rank itself
+DEFAULT_IMPORTANCE = 999
+
+# Files generated first, everything else is ordered by _rank
+FILE_PRIORITY = {"app.py": 1, "requirements.txt": 2}
+
+class FileDescription(BaseModel):
+    file_name: str
+    description: str
+    importance: Optional[int] = None  # For ranking files by importance
+
+class WebsiteStructure(BaseModel):
+    files: List[FileDescription]
+
+class LineEdit(BaseModel):
+    op: Literal["replace", "insert_after", "delete"]
+    line: int  # 1-based line number in the current file, 0 inserts at the top
+    text: Optional[str] = None
+
+class FilePatch(BaseModel):
+    edits: List[LineEdit]
+
+class TruncatedOutputError(ValueError):
+    """Raised when a completion stops at its max_tokens limit."""
+
+_exponential_backoff = wait_random_exponential(min=1, max=30)
+
+def wait_for_retry_after(retry_state):
+    """Wait as long as a rate limit response asks for, otherwise back off exponentially with jitter."""
+    error = retry_state.outcome.exception()
+    if isinstance(error, openai.RateLimitError):
+        retry_after = error.response.headers.get("retry-after")
+        if retry_after:
+            try:
+                return min(float(retry_after), LLM_MAX_RETRY_AFTER)
+            except ValueError:
+                pass
+    return _exponential_backoff(retry_state)
+
+llm_retry = retry(
+    wait=wait_for_retry_after,
+    stop=stop_after_attempt(LLM_MAX_ATTEMPTS),
+    retry=retry_if_exception_type(RETRYABLE_OPENAI_ERRORS),
+    reraise=True
+)
+
+@llm_retry
+def call_llm(messages, model, **params):
+    """Run a chat completion and return the response content."""
+    completion = _get_client().chat.completions.create(
+        model=model,
+        messages=messages,
+        seed=OPENAI_SEED,
+        **params
+    )
+    if completion.choices[0].finish_reason == "length":
+        raise TruncatedOutputError("Output was truncated at the max_tokens limit")
+    return completion.choices[0].message.content
+
+@llm_retry
+async def stream_llm(async_client, messages, model, label="completion", **params):
+    """Stream a chat completion and return the full response content."""
+    # Stream the completion so the first tokens are visible as soon as they arrive
+    start_time = time.monotonic()
+    stream = await async_client.chat.completions.create(
+        model=model,
+        messages=messages,
+        seed=OPENAI_SEED,
+        stream=True,
+        **params
+    )
+    
+    content_chunks = []
+    finish_reason = None
+    async for chunk in stream:
+        if not chunk.choices:
+            continue
+        delta = chunk.choices[0].delta.content
+        if delta:
+            if not content_chunks:
+                logger.info(f"First token for {label} after {time.monotonic() - start_time:.2f}s")
+            content_chunks.append(delta)
+        finish_reason = chunk.choices[0].finish_reason or finish_reason
+    
+    # A cut-off file is never usable, so don't hand it back to be cached
+    if finish_reason == "length":
+        raise TruncatedOutputError(f"Output for {label} was truncated at the max_tokens limit")
+    logger.info(f"Generated {label} in {time.monotonic() - start_time:.2f}s")
+    return "".join(content_chunks)
+
+def cached_chat_completion(messages, model, **params):
+    """Run a chat completion, returning a cached response for identical requests."""
+    cache_key = get_cache_key(messages, model, seed=OPENAI_SEED, **params)
+    content = read_cached_response(cache_key)
+    if content is not None:
+        logger.info("Using cached chat completion")
+        return content
+    
+    content = call_llm(messages, model, **params)
+    write_cached_response(cache_key, content)
+    return content
+
+@llm_retry
+def parse_llm(messages, model, response_format, **params):
+    """Run a structured output chat completion and return the parsed Pydantic object."""
+    completion = _get_client().beta.chat.completions.parse(
+        model=model,
+        messages=messages,
+        response_format=response_format,
+        seed=OPENAI_SEED,
+        **params
+    )
+    message = completion.choices[0].message
+    if message.refusal:
+        raise ValueError(f"Model refused to answer: {message.refusal}")
+    return message.parsed
+
+def _parse_cache_key(messages, model, response_format, **params):
+    """Cache key for a structured output chat completion."""
+    return get_cache_key(messages, model, seed=OPENAI_SEED, response_format=response_format.model_json_schema(), **params)
+
+def read_cached_parse_completion(messages, model, response_format, **params):
+    """Return the cached result of an identical structured output request, or None."""
+    content = read_cached_response(_parse_cache_key(messages, model, response_format, **params))
+    if content is None:
+        return None
+    try:
+        result = response_format.model_validate_json(content)
+        logger.info("Using cached structured completion")
+        return result
+    except ValidationError:
+        logger.warning("Ignoring cached structured completion that no longer matches the schema")
+        return None
+
+def cached_parse_completion(messages, model, response_format, **params):
+    """Run a structured output chat completion, returning a cached result for identical requests."""
+    result = read_cached_parse_completion(messages, model, response_format, **params)
+    if result is not None:
+        return result
+    
+    cache_key = _parse_cache_key(messages, model, response_format, **params)
+    result = parse_llm(messages, model, response_format, **params)
+    write_cached_response(cache_key, result.model_dump_json())
+    return result
+
+def embed_text(text):
+    """Embed text for semantic cache lookups, returning None on failure or when caching is disabled."""
+    if CACHE_DISABLED:
+        return None
+    try:
+        return _get_client().embeddings.create(model=EMBEDDING_MODEL, input=text).data[0].embedding
+    except Exception as e:
+        logger.warning(f"Could not embed text for semantic cache: {str(e)}")
+        return None
+
+async def aembed_text(async_client, text):
+    """Embed text for semantic cache lookups with the async client, returning None on failure or when caching is disabled."""
+    if CACHE_DISABLED:
+        return None
+    try:
+        response = await async_client.embeddings.create(model=EMBEDDING_MODEL, input=text)
+        return response.data[0].embedding
+    except Exception as e:
+        logger.warning(f"Could not embed text for semantic cache: {str(e)}")
+        return None
+
+def _rank(file_name):
+    """Generation order of a file: the app first, then templates, static assets and docs."""
+    return FILE_PRIORITY.get(file_name, 100 + ("templates/" in file_name)*10 + ("static/" in file_name)*20 + ("README" in file_name)*50)
+
+def define_website_structure(website_description, model=MODEL_MAP["structure"]):
+    """Use OpenAI to define the file structure for the website based on description."""
+    _init_logging()
+    try:
+        system_prompt = {"role": "system", "content": "You are a helpful assistant."}
+        message_list = [system_prompt]
         
-        structure_content = completion.choices[0].message.content
+        user_prompt = _STRUCTURE_TMPL.substitute(website_description=website_description)
         
-        # Parse the JSON output
-        file_structures = json.loads(structure_content)
+        message_list.append({"role": "user", "content": user_prompt})
         
-        # Convert to Pydantic models
-        file_descriptions = [FileDescription(**file) for file in file_structures]
+        params = {"temperature": 0, "max_tokens": MAX_TOKENS["structure"]}
+        structure = read_cached_parse_completion(message_list, model, WebsiteStructure, **params)
+        if structure is None:
+            # On an exact miss, reuse the structure generated for a similar enough description
+            namespace = f"structure:{model}:{STRUCTURE_PROMPT_HASH}"
+            embedding = embed_text(website_description)
+            cached_structure = None
+            if embedding is not None:
+                cached_structure = read_semantic_cache(namespace, embedding, SEMANTIC_CACHE_THRESHOLD, SEMANTIC_CACHE_TTL)
+            
+            if cached_structure is not None:
+                logger.info("Using semantically cached website structure")
+                structure = WebsiteStructure.model_validate_json(cached_structure)
+            else:
+                # Structured outputs guarantee the response matches the schema
+                structure = cached_parse_completion(message_list, model, WebsiteStructure, **params)
+                if embedding is not None:
+                    write_semantic_cache(namespace, embedding, structure.model_dump_json(), SEMANTIC_CACHE_TTL)
+        file_descriptions = structure.files
         
         # Ensure app.py and requirements.txt exist
         essential_files = ["app.py", "requirements.txt"]
+        existing_files = {file.file_name for file in file_descriptions}
         for essential_file in essential_files:
-            if not any(file.file_name == essential_file for file in file_descriptions):
+            if essential_file not in existing_files:
                 file_descriptions.append(
-                    FileDescription(
+                    FileDescription.model_construct(
                         file_name=essential_file,
-                        description=f"This is the {essential_file} file for the app."
+                        description=f"This is the {essential_file} file for the app.",
+                        importance=DEFAULT_IMPORTANCE
                     )
                 )
         
-        # Have LLM rank files by importance
-        message_list.append({"role": "assistant", "content": structure_content})
-        
-        rank_prompt = f"""
-        Please rank the following files by importance, with 1 being the most important.
-        Output the result as a JSON list with the file name and its rank:
-        {structure_content}
-        
-        Example output:
-        [
-        {{
-            "file_name": "app.py",
-            "importance": 1
-        }},
-        {{
-            "file_name": "requirements.txt",
-            "importance": 2
-        }}
-        ]
-        
-        Do not include any other text. Do not include any markdown, code blocks, or explanations.
-        """
-        
-        message_list.append({"role": "user", "content": rank_prompt})
-        
-        completion = client.chat.completions.create(
-            model="gpt-4o",
-            messages=message_list
-        )
-        
-        ranking_content = completion.choices[0].message.content
-        rankings = json.loads(ranking_content)
-        
-        # Update importance in file descriptions
-        rank_map = {item["file_name"]: item["importance"] for item in rankings}
-        for file in file_descriptions:
-            if file.file_name in rank_map:
-                file.importance = rank_map[file.file_name]
-        
-        # Sort file descriptions by importance
-        file_descriptions.sort(key=lambda x: x.importance if x.importance is not None else 999)
+        # Sort deterministically by file type, using the model's rank only to break ties
+        file_descriptions.sort(key=lambda x: (_rank(x.file_name), x.importance if x.importance is not None else DEFAULT_IMPORTANCE))
         
         print(f"Defined website structure with {len(file_descriptions)} files")
         return file_descriptions
@@ -162,157 +577,411 @@ def define_website_structure(website_description):
         print(f"Error defining website structure: {e}")
         return None
 
-def generate_file_content(file_description, website_description, message_list=None):
+def _setting_for_file(settings, file_name):
+    """Look up a per-file setting by file name, then extension, then the default."""
+    base_name = os.path.basename(file_name)
+    extension = os.path.splitext(file_name)[1]
+    return settings.get(base_name) or settings.get(extension) or settings["default"]
+
+def select_model_for_file(file_name):
+    """Pick the model used to generate a file based on its type."""
+    return _setting_for_file(MODEL_MAP, file_name)
+
+def max_tokens_for_file(file_name):
+    """Pick the output token cap for a file based on its type."""
+    return _setting_for_file(MAX_TOKENS, file_name)
+
+def build_file_prompt(file_description, website_description, project_structure=""):
+    """Build the user prompt asking the model to write a single file."""
+    template = FILE_PROMPT_TEMPLATES.get(file_description.file_name, _GENERIC_TMPL)
+    return template.substitute(
+        file_name=file_description.file_name,
+        description=file_description.description,
+        website_description=website_description,
+        project_structure=project_structure
+    )
+
+async def generate_file_content(async_client, file_description, website_description, message_list=None, model=None, project_structure=""):
     """Generate content for a single file using OpenAI."""
     try:
+        if model is None:
+            model = select_model_for_file(file_description.file_name)
+        
         # If no message list is provided, create a new one
         if message_list is None:
-            system_prompt = {
-            "role": "system",
-            "content": "You are a code generation assistant. ALWAYS output ONLY valid, runnable code. DO NOT include explanations, markdown formatting, backticks, or extra text. No introductions, summaries, or additional commentary."
-            }
+            system_prompt = CODE_SYSTEM_PROMPT
             message_list = [system_prompt]
         
-        # Add special handling for app.py to ensure it binds to all interfaces
-        if file_description.file_name == "app.py":
-            user_prompt = f"""
-            Please write the file {file_description.file_name} with the following description:
-            {file_description.description}
-            
-            The website description is:
-            {website_description}
-            
-            IMPORTANT CONSTRAINTS:
-            1. Make sure the Flask app is properly configured to run on all interfaces (0.0.0.0)
-            2. Set debug=True during development
-            3. Include error handlers for common HTTP errors
-            4. Wrap route handlers in try/except blocks to prevent unhandled exceptions
-            
-            ALWAYS output ONLY valid, runnable code. DO NOT include explanations, markdown formatting, backticks, or extra text. No introductions, summaries, or additional commentary.
-            """
-        # Add special handling for requirements.txt
-        elif file_description.file_name == "requirements.txt":
-            user_prompt = f"""
-            Please write the file {file_description.file_name} with the following description:
-            {file_description.description}
-            
-            The website description is:
-            {website_description}
-            
-            IMPORTANT CONSTRAINTS:
-            1. Include only the absolute minimum required dependencies
-            2. DO NOT include version numbers for any package
-            3. Each dependency should be on its own line with no version constraints
-            4. Include only well-established, widely-used packages
-            5. Ensure necessary dependencies are included for the app to run such as flask, gunicorn, etc.
-            
-            ALWAYS output ONLY valid, runnable code. DO NOT include explanations, markdown formatting, backticks, or extra text. No introductions, summaries, or additional commentary.
-            """
-        else:
-            user_prompt = f"""
-            Please write the file {file_description.file_name} with the following description:
-            {file_description.description}
-            
-            The website description is:
-            {website_description}
-            
-            ALWAYS output ONLY valid, runnable code. DO NOT include explanations, markdown formatting, backticks, or extra text. No introductions, summaries, or additional commentary.
-            """
+        user_prompt = build_file_prompt(file_description, website_description, project_structure)
         
         # Use the existing message list and add the new user prompt
         message_list.append({"role": "user", "content": user_prompt})
         
-        completion = client.chat.completions.create(
-            model="gpt-4o",
-            messages=message_list,
-        )
+        # Reuse a previous response to the exact same request if there is one
+        max_tokens = max_tokens_for_file(file_description.file_name)
+        cache_key = get_cache_key(message_list, model, seed=OPENAI_SEED, max_tokens=max_tokens)
+        cached_content = read_cached_response(cache_key)
+        if cached_content is not None:
+            logger.info(f"Using cached content for {file_description.file_name}")
+            return cached_content
+        
+        # Fall back to the same file generated for a similar site with the same project structure,
+        # so templates are only reused next to an app.py planned with the same routes
+        structure_hash = hashlib.sha1(project_structure.encode("utf-8")).hexdigest()
+        namespace = f"file:{model}:{file_description.file_name}:{structure_hash}"
+        threshold = _setting_for_file(SEMANTIC_CACHE_THRESHOLDS, file_description.file_name)
+        embedding = None
+        if threshold < 1.0:
+            embedding = await aembed_text(async_client, f"{file_description.description}\n{website_description}")
+        if embedding is not None:
+            cached_content = read_semantic_cache(namespace, embedding, threshold, SEMANTIC_CACHE_TTL)
+            if cached_content is not None:
+                logger.info(f"Using semantically cached content for {file_description.file_name}")
+                return cached_content
         
-        file_content = completion.choices[0].message.content
-        logger.info(f"Generated content for {file_description.file_name}")
+        try:
+            file_content = await stream_llm(async_client, message_list, model, label=file_description.file_name, max_tokens=max_tokens)
+        except TruncatedOutputError as e:
+            logger.warning(f"{e}, retrying with a higher limit")
+            file_content = await stream_llm(
+                async_client, message_list, model, label=file_description.file_name,
+                max_tokens=max_tokens * TRUNCATED_RETRY_FACTOR
+            )
+        write_cached_response(cache_key, file_content)
+        if embedding is not None:
+            write_semantic_cache(namespace, embedding, file_content, SEMANTIC_CACHE_TTL)
         
         # Return the file content
         return file_content
     except Exception as e:
-        error_details = traceback.format_exc()
-        logger.error(f"Error generating content for {file_description.file_name}: {str(e)}\n{error_details}")
+        logger.error("Error generating content for %s: %s", file_description.file_name, e, exc_info=True)
+        return None
+
+async def generate_and_write_files(sandbox, file_descriptions, website_description, message_list, num_writers=MAX_SANDBOX_WRITERS, max_concurrency=MAX_CONCURRENT_GENERATIONS, project_structure=""):
+    """Generate all files concurrently, writing each one to the sandbox as soon as it is ready.
+    
+    Returns the (file_name, content) pairs that were written.
+    """
+    semaphore = asyncio.Semaphore(max_concurrency)
+    write_queue = asyncio.Queue()
+    written_files = []
+    async_client = _get_async_client()
+    
+    def create_directories():
+        dir_paths = sorted({os.path.dirname(file_desc.file_name) for file_desc in file_descriptions if os.path.dirname(file_desc.file_name)})
+        if not dir_paths:
+            return
+        try:
+            sandbox.commands.run("mkdir -p " + " ".join(shlex.quote(f"/home/user/{d}") for d in dir_paths))
+            logger.debug(f"Created directories: {', '.join(dir_paths)}")
+        except Exception as e:
+            logger.error(f"Failed to create directories {dir_paths}: {str(e)}")
+    
+    # Create every needed directory with one command while the first completions are generated
+    directories_created = asyncio.create_task(asyncio.to_thread(create_directories))
+    
+    async def produce(file_desc):
+        async with semaphore:
+            logger.info(f"Generating content for {file_desc.file_name}")
+            # Give each request its own copy of the shared context
+            file_content = await generate_file_content(async_client, file_desc, website_description, list(message_list), project_structure=project_structure)
+        if file_content:
+            await write_queue.put((file_desc.file_name, file_content))
+        else:
+            logger.warning(f"Failed to generate content for {file_desc.file_name}, skipping file")
+    
+    async def consume():
+        while True:
+            item = await write_queue.get()
+            if item is None:
+                return
+            file_name, file_content = item
+            try:
+                await directories_created
+                await asyncio.to_thread(sandbox.files.write, f"/home/user/{file_name}", file_content)
+                written_files.append((file_name, file_content))
+                logger.info(f"Wrote {file_name} to sandbox")
+            except Exception as e:
+                logger.error(f"Failed to write {file_name} to sandbox: {str(e)}")
+    
+    consumers = [asyncio.create_task(consume()) for _ in range(num_writers)]
+    try:
+        results = await asyncio.gather(*[produce(file_desc) for file_desc in file_descriptions], return_exceptions=True)
+        for file_desc, result in zip(file_descriptions, results):
+            if isinstance(result, Exception):
+                logger.error(f"Error generating content for {file_desc.file_name}: {str(result)}")
+    finally:
+        # One sentinel per writer once every producer is done
+        for _ in consumers:
+            await write_queue.put(None)
+        await asyncio.gather(*consumers)
+        await directories_created
+    return written_files
+
+def generate_file_contents_batch(file_descriptions, website_description, message_list, model=MODEL_MAP["batch"], poll_interval=BATCH_POLL_INTERVAL, timeout=BATCH_TIMEOUT, project_structure=""):
+    """Generate content for all files with a single OpenAI Batch API job.
+    
+    Every request in a batch must use the same model, so one model is used for all files.
+    """
+    try:
+        # Build one JSONL request per file, keyed by file name
+        batch_lines = []
+        for file_desc in file_descriptions:
+            messages = list(message_list) + [{"role": "user", "content": build_file_prompt(file_desc, website_description, project_structure)}]
+            batch_lines.append(orjson.dumps({
+                "custom_id": file_desc.file_name,
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": {"model": model, "messages": messages, "max_tokens": max_tokens_for_file(file_desc.file_name)}
+            }))
+        
+        # Transient errors are retried so a submitted batch is not abandoned
+        batch_input = llm_retry(_get_client().files.create)(
+            file=("website_files.jsonl", b"\n".join(batch_lines)),
+            purpose="batch"
+        )
+        batch = llm_retry(_get_client().batches.create)(
+            input_file_id=batch_input.id,
+            endpoint="/v1/chat/completions",
+            completion_window="24h"
+        )
+        logger.info(f"Submitted batch {batch.id} with {len(batch_lines)} requests")
+        
+        # Poll until the batch finishes, giving up after the timeout
+        deadline = time.monotonic() + timeout
+        while batch.status not in ("completed", "failed", "expired", "cancelled"):
+            if time.monotonic() > deadline:
+                logger.warning(f"Batch {batch.id} did not complete within {timeout} seconds, cancelling")
+                _get_client().batches.cancel(batch.id)
+                return None
+            time.sleep(poll_interval)
+            batch = llm_retry(_get_client().batches.retrieve)(batch.id)
+        
+        if batch.status != "completed" or not batch.output_file_id:
+            logger.error(f"Batch {batch.id} finished with status {batch.status}")
+            return None
+        
+        # Map each response back to its file
+        contents_by_file = {}
+        for line in llm_retry(_get_client().files.content)(batch.output_file_id).text.splitlines():
+            result = orjson.loads(line)
+            response = result.get("response") or {}
+            if response.get("status_code") == 200:
+                choice = response["body"]["choices"][0]
+                if choice.get("finish_reason") == "length":
+                    logger.error(f"Batch output for {result['custom_id']} was truncated at the max_tokens limit")
+                    continue
+                contents_by_file[result["custom_id"]] = choice["message"]["content"]
+            else:
+                logger.error(f"Batch request for {result['custom_id']} failed: {result.get('error')}")
+        
+        logger.info(f"Batch {batch.id} completed with {len(contents_by_file)} files")
+        return [contents_by_file.get(file_desc.file_name) for file_desc in file_descriptions]
+    except Exception as e:
+        logger.error("Error generating files with the Batch API: %s", e, exc_info=True)
         return None
 
-def generate_website_in_sandbox(website_description):
-    """Generate website files and save them to an e2b sandbox."""
+def write_files_to_sandbox(sandbox, files):
+    """Write (file_name, content) pairs under /home/user in the sandbox."""
+    # Pack every file into one in-memory archive so the upload is a single request
+    archive = io.BytesIO()
+    with tarfile.open(fileobj=archive, mode="w:gz") as tar:
+        for file_name, content in files:
+            data = content.encode("utf-8")
+            tar_info = tarfile.TarInfo(file_name)
+            tar_info.size = len(data)
+            tar_info.mode = 0o644
+            tar_info.mtime = int(time.time())
+            tar.addfile(tar_info, io.BytesIO(data))
+    
+    try:
+        # Extracting the archive also creates any directories the files need
+        sandbox.files.write("/home/user/site.tgz", archive.getvalue())
+        sandbox.commands.run("cd /home/user && tar xzf site.tgz && rm site.tgz")
+        logger.info(f"Wrote {len(files)} files to sandbox: {', '.join(file_name for file_name, _ in files)}")
+    except Exception as e:
+        logger.error(f"Failed to write files to sandbox: {str(e)}")
+
+def get_sandbox():
+    """Return an idle sandbox from the pool, or create a new one."""
+    while True:
+        try:
+            sandbox = _sandbox_pool.get_nowait()
+        except queue.Empty:
+            break
+        try:
+            if sandbox.is_running():
+                # The timeout counts from creation, restart it so the build gets the full hour
+                sandbox.set_timeout(SANDBOX_TIMEOUT)
+                logger.info(f"Reusing pooled sandbox: {sandbox.sandbox_id}")
+                return sandbox
+        except Exception as e:
+            logger.warning(f"Could not check pooled sandbox {sandbox.sandbox_id}: {str(e)}")
+    
+    sandbox = Sandbox(template=SANDBOX_TEMPLATE, timeout=SANDBOX_TIMEOUT)
+    logger.info(f"Created sandbox: {sandbox.sandbox_id}")
+    return sandbox
+
+def release_sandbox(sandbox):
+    """Clean up a sandbox and return it to the pool for the next build."""
+    try:
+        # Stop any servers and remove the generated files in a single command; the bracketed
+        # patterns keep pkill from matching (and killing) the shell running this command
+        sandbox.commands.run("pkill -f '[g]unicorn'; pkill -f '[f]rom app import app'; rm -rf /home/user/*; true")
+    except Exception as e:
+        logger.warning(f"Could not clean sandbox {sandbox.sandbox_id}, discarding it: {str(e)}")
+        try:
+            sandbox.kill()
+        except Exception:
+            pass
+        return
+    
+    # Fixes memoized for this sandbox refer to files that no longer exist
+    for regen_key in [key for key in list(_regen_cache) if key[0] == sandbox.sandbox_id]:
+        _regen_cache.pop(regen_key, None)
+    _pending_bundles.pop(sandbox.sandbox_id, None)
+    
+    try:
+        _sandbox_pool.put_nowait(sandbox)
+        logger.info(f"Returned sandbox to pool: {sandbox.sandbox_id}")
+    except queue.Full:
+        logger.info(f"Sandbox pool is full, killing sandbox: {sandbox.sandbox_id}")
+        try:
+            sandbox.kill()
+        except Exception:
+            pass
+
+async def agenerate_website_in_sandbox(website_description, use_batch_api=False, sandbox=None):
+    """Generate website files and save them to an e2b sandbox.
+    
+    With use_batch_api, file contents are generated through the OpenAI Batch API,
+    which is cheaper but can take much longer than concurrent requests.
+    When no sandbox is given, one is taken from the pool or created.
+    Generation always runs on the run_async loop, whichever loop awaits this,
+    since the shared async OpenAI client must only be used there.
+    """
+    return await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(
+        _agenerate_website_in_sandbox(website_description, use_batch_api=use_batch_api, sandbox=sandbox),
+        _get_event_loop()
+    ))
+
+async def _agenerate_website_in_sandbox(website_description, use_batch_api=False, sandbox=None):
+    """Generate the website on the run_async loop; see agenerate_website_in_sandbox."""
+    _init_logging()
+    owns_sandbox = sandbox is None
     try:
         logger.info("Starting website generation in sandbox")
-        # Define the website structure
-        file_descriptions = define_website_structure(website_description)
+        
+        # Identical descriptions reuse the whole generated site without any LLM calls
+        bundle_key = get_bundle_key(website_description, SITE_BUNDLE_VERSION)
+        cached_bundle = read_cached_response(bundle_key)
+        if cached_bundle is not None:
+            logger.info("Using cached site bundle")
+            if sandbox is None:
+                sandbox = await asyncio.to_thread(get_sandbox)
+            await asyncio.to_thread(write_files_to_sandbox, sandbox, [tuple(file) for file in cached_bundle])
+            logger.info(f"Website generation completed in sandbox: {sandbox.sandbox_id}")
+            return sandbox
+        
+        # Define the website structure while a clean sandbox boots, unless the caller provided one
+        if sandbox is None:
+            file_descriptions, sandbox = await asyncio.gather(
+                asyncio.to_thread(define_website_structure, website_description),
+                asyncio.to_thread(get_sandbox)
+            )
+        else:
+            file_descriptions = await asyncio.to_thread(define_website_structure, website_description)
         if not file_descriptions:
             logger.error("Failed to define website structure")
+            if owns_sandbox:
+                await asyncio.to_thread(release_sandbox, sandbox)
             return None
         
-        # Create a sandbox
-        sandbox = Sandbox(timeout=60*60)
-        logger.info(f"Created sandbox: {sandbox.sandbox_id}")
-        
-        # Initialize the message list with system prompt and project structure
-        system_prompt = {
-        "role": "system",
-        "content": "You are a code generation assistant. ALWAYS output ONLY valid, runnable code. DO NOT include explanations, markdown formatting, backticks, or extra text. No introductions, summaries, or additional commentary."
-        }
+        # Every file request is [system, user]; the project structure goes into the shared start of the user prompt
+        system_prompt = CODE_SYSTEM_PROMPT
         message_list = [system_prompt]
-        
-        # Add file structure information to the message list
         file_structure_info = "Project structure:\n" + "\n".join([f"- {file.file_name}: {file.description}" for file in file_descriptions])
-        message_list.append({"role": "user", "content": f"I'm building a web application with the following description:\n{website_description}\n\n{file_structure_info}"})
-        message_list.append({"role": "assistant", "content": "I'll help you generate the code for each file in this project structure."})
         
-        # Generate and write each file
-        for file_desc in file_descriptions:
-            # Generate file content
-            logger.info(f"Generating content for {file_desc.file_name}")
-            file_content = generate_file_content(file_desc, website_description, message_list)
-            if not file_content:
-                logger.warning(f"Failed to generate content for {file_desc.file_name}, skipping file")
-                continue
-            
-            # Add the generated file content to the message history for context
-            message_list.append({"role": "user", "content": f"Please confirm the content for {file_desc.file_name}"})
-            message_list.append({"role": "assistant", "content": file_content})
-            
-            # Create directory structure in sandbox if needed
-            dir_path = os.path.dirname(file_desc.file_name)
-            if dir_path:
-                try:
-                    sandbox.commands.run(f"mkdir -p /home/user/{dir_path}")
-                    logger.debug(f"Created directory: /home/user/{dir_path}")
-                except Exception as e:
-                    logger.error(f"Failed to create directory {dir_path}: {str(e)}")
+        file_contents = None
+        if use_batch_api:
+            file_contents = await asyncio.to_thread(generate_file_contents_batch, file_descriptions, website_description, message_list, project_structure=file_structure_info)
+            if file_contents is None:
+                logger.warning("Batch generation failed, falling back to concurrent requests")
+        
+        if file_contents is not None:
+            # Batch results arrive together, so upload them in one go
+            generated_files = []
+            for file_desc, file_content in zip(file_descriptions, file_contents):
+                if not file_content:
+                    logger.warning(f"Failed to generate content for {file_desc.file_name}, skipping file")
                     continue
-            
-            # Write file to sandbox
-            try:
-                sandbox_path = f"/home/user/{file_desc.file_name}"
-                sandbox.files.write(sandbox_path, file_content)
-                logger.info(f"Wrote {file_desc.file_name} to sandbox")
-            except Exception as e:
-                logger.error(f"Failed to write {file_desc.file_name} to sandbox: {str(e)}")
+                generated_files.append((file_desc.file_name, file_content))
+            await asyncio.to_thread(write_files_to_sandbox, sandbox, generated_files)
+        else:
+            # Generate all files concurrently, each request sharing the same system prompt and prompt prefix
+            generated_files = await generate_and_write_files(sandbox, file_descriptions, website_description, message_list, project_structure=file_structure_info)
+        
+        # Only complete sites are cached, and only once they have run, a broken one would be served forever
+        if len(generated_files) == len(file_descriptions):
+            _pending_bundles[sandbox.sandbox_id] = (bundle_key, generated_files)
         
         logger.info(f"Website generation completed in sandbox: {sandbox.sandbox_id}")
         return sandbox
     except Exception as e:
-        error_details = traceback.format_exc()
-        logger.error(f"Error generating website in sandbox: {str(e)}\n{error_details}")
+        logger.error("Error generating website in sandbox: %s", e, exc_info=True)
+        if owns_sandbox and sandbox is not None:
+            await asyncio.to_thread(release_sandbox, sandbox)
         return None
 
-def run_website_in_sandbox(sandbox, port=5000, public_access=False):
+def generate_website_in_sandbox(website_description, use_batch_api=False, sandbox=None):
+    """Synchronous wrapper around agenerate_website_in_sandbox for callers without an event loop."""
+    return run_async(_agenerate_website_in_sandbox(website_description, use_batch_api=use_batch_api, sandbox=sandbox))
+
+def wait_for_server(sandbox, port, pid=None, log_file=None, timeout=READINESS_TIMEOUT):
+    """Poll the server inside the sandbox until it answers HTTP requests.
+    
+    The whole polling loop runs in one command, stopping early if the process with the given pid exits.
+    Returns whether the server is ready and the contents of log_file, read in the same command.
+    """
+    ready_codes = "|".join(READY_STATUS_CODES)
+    process_check = f"kill -0 {pid} 2>/dev/null || {{ status=exited; break; }}; " if pid else ""
+    script = (
+        f"status=timeout; delay={READINESS_INITIAL_DELAY}; end=$((SECONDS+{timeout})); "
+        f"while [ $SECONDS -lt $end ]; do "
+        f"code=$(curl -s -o /dev/null -w '%{{http_code}}' http://127.0.0.1:{port}/); "
+        f"case \"$code\" in {ready_codes}) status=ready; break;; esac; "
+        f"{process_check}"
+        f"sleep $delay; delay=$(awk \"BEGIN {{ d = $delay * 2; print (d > {READINESS_MAX_DELAY} ? {READINESS_MAX_DELAY} : d) }}\"); "
+        f"done; echo $status"
+    )
+    if log_file:
+        script += f"; cat {shlex.quote(log_file)} 2>/dev/null; true"
+    result = sandbox.commands.run(script, timeout=timeout + 30)
+    status, _, logs = result.stdout.partition("\n")
+    if status != "ready":
+        logger.warning(f"Server on port {port} is not ready: {status}")
+    return status == "ready", logs
+
+def run_website_in_sandbox(sandbox=None, port=5000, public_access=False):
     """Run the generated website in the sandbox."""
+    _init_logging()
+    if sandbox is None:
+        sandbox = get_sandbox()
     try:
         # Install requirements
         logger.info("Installing requirements...")
         max_retries = 3
         retry_count = 0
         
+        # When serving publicly, gunicorn is installed together with the other requirements
+        ensure_gunicorn = ""
+        if public_access:
+            ensure_gunicorn = "(grep -qiE '^gunicorn([^a-z0-9_.-]|$)' requirements.txt || printf '\\ngunicorn\\n' >> requirements.txt) && "
+        
         while retry_count < max_retries:
             try:
                 # Try to install requirements
-                result = sandbox.commands.run("cd /home/user && pip install -r requirements.txt")
+                result = sandbox.commands.run(f"cd /home/user && {ensure_gunicorn}{PIP_INSTALL} -r requirements.txt")
                 logger.info("Requirements installed successfully")
                 break  # If successful, exit the retry loop
             except Exception as e:
@@ -324,9 +993,25 @@ def run_website_in_sandbox(sandbox, port=5000, public_access=False):
                     logger.error(f"Failed to install requirements after {max_retries} attempts")
                     raise
                 
+                # The previous fix for this exact error did not help, asking again won't either
+                if get_regeneration_key(sandbox, "requirements.txt", error_message) in _regen_cache:
+                    logger.error("Same requirements error after applying a fix, giving up")
+                    raise
+                
+                # Dropping the package pip could not resolve is enough most of the time
+                try:
+                    current_requirements = sandbox.files.read("/home/user/requirements.txt")
+                except Exception:
+                    current_requirements = ""
+                fixed_requirements = _fix_requirements_locally(current_requirements, error_message)
+                if fixed_requirements != current_requirements:
+                    sandbox.files.write("/home/user/requirements.txt", fixed_requirements)
+                    logger.info("Removed unresolvable package from requirements.txt")
+                    continue
+                
                 logger.info(f"Attempting to fix requirements.txt (attempt {retry_count}/{max_retries})")
                 # Regenerate requirements.txt with error context
-                file_desc = FileDescription(
+                file_desc = FileDescription.model_construct(
                     file_name="requirements.txt",
                     description="Requirements file for the app"
                 )
@@ -340,29 +1025,21 @@ def run_website_in_sandbox(sandbox, port=5000, public_access=False):
             logger.info("Setting up gunicorn server...")
             retry_count = 0
             while retry_count < max_retries:
+                server_logs = None
                 try:
-                    sandbox.commands.run("pip install gunicorn")
-                    logger.info("Gunicorn installed successfully")
-                    
-                    # Create a log file in the sandbox for server output
-                    sandbox.commands.run("touch /home/user/server.log")
-                    
-                    # Add more verbose logging for gunicorn
+                    # A single preloaded worker boots fastest and surfaces import errors in the master process
                     process = sandbox.commands.run(
-                        "cd /home/user && gunicorn --bind 0.0.0.0:5000 --log-level debug app:app > server.log 2>&1", 
+                        f"cd /home/user && gunicorn --preload --workers 1 --bind 0.0.0.0:{port} --log-level debug app:app > server.log 2>&1", 
                         background=True
                     )
                     logger.info("Gunicorn server started")
                     
-                    # Verify the server is actually running
-                    sandbox.commands.run("sleep 2")  # Give it time to start
-                    check_result = sandbox.commands.run("ps aux | grep gunicorn")
-                    
-                    # Check server logs for errors
-                    server_logs = sandbox.commands.run("cat /home/user/server.log").stdout
-                    logger.info(f"Initial server logs:\n{server_logs}")
+                    # Verify the server is actually accepting requests and collect its logs in the same command
+                    ready, server_logs = wait_for_server(sandbox, port, pid=process.pid, log_file="/home/user/server.log")
+                    logger.info("Initial server logs:\n%s", server_logs)
                     
-                    if "app:app" not in check_result.stdout:
+                    if not ready:
+                        process.kill()
                         logger.error("Gunicorn server failed to start properly")
                         raise Exception("Gunicorn server failed to start properly")
                     break
@@ -370,12 +1047,14 @@ def run_website_in_sandbox(sandbox, port=5000, public_access=False):
                     error_message = str(e)
                     logger.error(f"Error starting gunicorn server (attempt {retry_count+1}/{max_retries}): {error_message}")
                     
-                    # Get detailed error information
-                    try:
-                        error_logs = sandbox.commands.run("cat /home/user/server.log").stdout
-                        logger.error(f"Server error logs:\n{error_logs}")
-                    except:
-                        logger.error("Could not retrieve server error logs")
+                    # Get detailed error information, unless the readiness probe already returned it
+                    error_logs = server_logs or ""
+                    if server_logs is None:
+                        try:
+                            error_logs = sandbox.commands.run("cat /home/user/server.log").stdout
+                            logger.error("Server error logs:\n%s", error_logs)
+                        except:
+                            logger.error("Could not retrieve server error logs")
                     
                     retry_count += 1
                     
@@ -383,13 +1062,23 @@ def run_website_in_sandbox(sandbox, port=5000, public_access=False):
                         logger.error(f"Failed to start server after {max_retries} attempts")
                         raise
                     
+                    # A missing module only needs its package installed, not a new app.py
+                    if install_missing_module(sandbox, f"{error_message}\n{error_logs}"):
+                        continue
+                    
+                    # The previous fix for this exact error did not help, asking again won't either
+                    server_error = f"{error_message}\n{normalize_server_log(error_logs)[-ERROR_LOG_TAIL_CHARS:]}"
+                    if get_regeneration_key(sandbox, "app.py", server_error) in _regen_cache:
+                        logger.error("Same server error after applying a fix, giving up")
+                        raise
+                    
                     logger.info(f"Attempting to fix app.py (attempt {retry_count}/{max_retries})")
                     # Regenerate app.py with error context
-                    file_desc = FileDescription(
+                    file_desc = FileDescription.model_construct(
                         file_name="app.py",
                         description="Main application file"
                     )
-                    fixed_content = regenerate_file_with_error(file_desc, error_message, sandbox)
+                    fixed_content = regenerate_file_with_error(file_desc, server_error, sandbox)
                     if fixed_content:
                         sandbox.files.write("/home/user/app.py", fixed_content)
                         logger.info("Regenerated app.py")
@@ -397,29 +1086,21 @@ def run_website_in_sandbox(sandbox, port=5000, public_access=False):
             logger.info("Starting Flask development server...")
             retry_count = 0
             while retry_count < max_retries:
+                flask_logs = None
                 try:
-                    # Create a log file in the sandbox for Flask output
-                    sandbox.commands.run("touch /home/user/flask.log")
-                    
                     # Ensure Flask app runs with the right host and debug settings
                     process = sandbox.commands.run(
-                        "cd /home/user && FLASK_ENV=development python -c 'from app import app; app.run(host=\"0.0.0.0\", port=5000, debug=True)' > flask.log 2>&1", 
+                        f"cd /home/user && FLASK_ENV=development python -c 'from app import app; app.run(host=\"0.0.0.0\", port={port}, debug=True)' > flask.log 2>&1", 
                         background=True
                     )
                     logger.info("Flask development server started")
                     
-                    # Check if server is running
-                    sandbox.commands.run("sleep 2")  # Give it time to start
-                    check_result = sandbox.commands.run("ps aux | grep 'python -c'")
+                    # Check if server is accepting requests and collect its logs in the same command
+                    ready, flask_logs = wait_for_server(sandbox, port, pid=process.pid, log_file="/home/user/flask.log")
+                    logger.info("Initial Flask logs:\n%s", flask_logs)
                     
-                    # Check server logs for errors
-                    try:
-                        flask_logs = sandbox.commands.run("cat /home/user/flask.log").stdout
-                        logger.info(f"Initial Flask logs:\n{flask_logs}")
-                    except:
-                        logger.warning("Could not retrieve initial Flask logs")
-                    
-                    if "app.run" not in check_result.stdout:
+                    if not ready:
+                        process.kill()
                         logger.error("Flask server failed to start properly")
                         raise Exception("Flask server failed to start properly")
                     break
@@ -427,12 +1108,14 @@ def run_website_in_sandbox(sandbox, port=5000, public_access=False):
                     error_message = str(e)
                     logger.error(f"Error starting Flask server (attempt {retry_count+1}/{max_retries}): {error_message}")
                     
-                    # Get detailed error information
-                    try:
-                        error_logs = sandbox.commands.run("cat /home/user/flask.log").stdout
-                        logger.error(f"Flask error logs:\n{error_logs}")
-                    except:
-                        logger.error("Could not retrieve Flask error logs")
+                    # Get detailed error information, unless the readiness probe already returned it
+                    error_logs = flask_logs or ""
+                    if flask_logs is None:
+                        try:
+                            error_logs = sandbox.commands.run("cat /home/user/flask.log").stdout
+                            logger.error("Flask error logs:\n%s", error_logs)
+                        except:
+                            logger.error("Could not retrieve Flask error logs")
                     
                     retry_count += 1
                     
@@ -440,13 +1123,23 @@ def run_website_in_sandbox(sandbox, port=5000, public_access=False):
                         logger.error(f"Failed to start server after {max_retries} attempts")
                         raise
                     
+                    # A missing module only needs its package installed, not a new app.py
+                    if install_missing_module(sandbox, f"{error_message}\n{error_logs}"):
+                        continue
+                    
+                    # The previous fix for this exact error did not help, asking again won't either
+                    server_error = f"{error_message}\n{normalize_server_log(error_logs)[-ERROR_LOG_TAIL_CHARS:]}"
+                    if get_regeneration_key(sandbox, "app.py", server_error) in _regen_cache:
+                        logger.error("Same server error after applying a fix, giving up")
+                        raise
+                    
                     logger.info(f"Attempting to fix app.py (attempt {retry_count}/{max_retries})")
                     # Regenerate app.py with error context
-                    file_desc = FileDescription(
+                    file_desc = FileDescription.model_construct(
                         file_name="app.py",
                         description="Main application file"
                     )
-                    fixed_content = regenerate_file_with_error(file_desc, error_message, sandbox)
+                    fixed_content = regenerate_file_with_error(file_desc, server_error, sandbox)
                     if fixed_content:
                         sandbox.files.write("/home/user/app.py", fixed_content)
                         logger.info("Regenerated app.py")
@@ -456,60 +1149,173 @@ def run_website_in_sandbox(sandbox, port=5000, public_access=False):
         url = f"https://{host}"
         logger.info(f"Website running at: {url}")
         
-        # Add logging to help diagnose issues
-        logger.info("Checking server logs...")
-        try:
-            logs = sandbox.commands.run("cd /home/user && cat *.log 2>/dev/null || echo 'No logs found'")
-            logger.info(f"Server logs:\n{logs.stdout}")
-        except Exception as log_error:
-            logger.error(f"Could not retrieve logs: {log_error}")
-        
+        store_site_bundle(sandbox)
         return {
             "process": process,
             "url": url,
             "sandbox": sandbox
         }
     except Exception as e:
-        error_details = traceback.format_exc()
-        logger.error(f"Error running website in sandbox: {str(e)}\n{error_details}")
+        logger.error("Error running website in sandbox: %s", e, exc_info=True)
         check_sandbox_logs(sandbox)  # Try to get as much log info as possible
         return None
 
-def regenerate_file_with_error(file_description, error_message, sandbox):
+def normalize_server_log(logs):
+    """Strip the parts of a server log that differ between runs of the same failure."""
+    for pattern in VOLATILE_LOG_PATTERNS:
+        logs = pattern.sub("", logs)
+    return logs
+
+def store_site_bundle(sandbox):
+    """Cache the site generated in a sandbox, now that it has run successfully."""
+    pending = _pending_bundles.pop(sandbox.sandbox_id, None)
+    if pending is None:
+        return
+    bundle_key, generated_files = pending
+    try:
+        files = [
+            (file_name, sandbox.files.read(f"/home/user/{file_name}") if file_name in RUN_MODIFIED_FILES else content)
+            for file_name, content in generated_files
+        ]
+    except Exception as e:
+        logger.warning(f"Could not read back the site to cache it: {str(e)}")
+        return
+    write_cached_response(bundle_key, files)
+
+def _requirement_name(requirement):
+    """Normalized package name of a requirements.txt line or pip requirement string."""
+    name = re.split(r"[\s<>=!~;@\[]", requirement.strip(), maxsplit=1)[0]
+    return name.lower().replace("_", "-")
+
+def _fix_requirements_locally(current, error_message):
+    """Drop the requirement pip could not resolve, returning the content unchanged if none is named."""
+    for pattern in PIP_UNRESOLVED_PATTERNS:
+        match = pattern.search(error_message)
+        if match:
+            package = _requirement_name(match.group(1))
+            lines = [line for line in current.splitlines() if _requirement_name(line) != package]
+            return "\n".join(lines) + "\n"
+    return current
+
+def install_missing_module(sandbox, error_output):
+    """Install the package for a ModuleNotFoundError and add it to requirements.txt."""
+    match = MISSING_MODULE_PATTERN.search(error_output)
+    if not match:
+        return False
+    
+    module = match.group(1).split(".")[0]
+    if module not in KNOWN_PACKAGE_MODULES:
+        logger.info(f"Not installing unknown module {module}, it may be one of the site's own files")
+        return False
+    
+    package = shlex.quote(MODULE_PACKAGE_NAMES.get(module, module))
+    try:
+        # A module of the site's own shadows the package, installing it would not help
+        result = sandbox.commands.run(
+            f"cd /home/user && if [ -e {module}.py ] || [ -d {module} ]; then echo local; "
+            f"else {PIP_INSTALL} {package} >/dev/null && printf '\\n%s\\n' {package} >> requirements.txt; fi"
+        )
+        if result.stdout.strip() == "local":
+            logger.info(f"Module {module} is part of the site, not installing a package for it")
+            return False
+        logger.info(f"Installed missing package {package}")
+        return True
+    except Exception as e:
+        logger.error(f"Could not install missing package {package}: {str(e)}")
+        return False
+
+def get_regeneration_key(sandbox, file_name, error_message):
+    """Key identifying a fix request for a file and error in a sandbox."""
+    return (sandbox.sandbox_id, file_name, hashlib.sha1(error_message.encode("utf-8")).hexdigest())
+
+def apply_line_patch(content, edits):
+    """Apply line edits to content, returning None if an edit does not fit the file."""
+    lines = content.splitlines()
+    # Apply from the bottom up so earlier line numbers stay valid, inserts before edits to the same line
+    for edit in sorted(edits, key=lambda e: (e.line, e.op == "insert_after"), reverse=True):
+        if edit.op == "insert_after":
+            if not 0 <= edit.line <= len(lines):
+                return None
+            lines[edit.line:edit.line] = (edit.text or "").splitlines()
+        else:
+            if not 1 <= edit.line <= len(lines):
+                return None
+            if edit.op == "replace":
+                lines[edit.line - 1:edit.line] = (edit.text or "").splitlines()
+            else:
+                del lines[edit.line - 1]
+    return "\n".join(lines) + "\n"
+
+def patch_file_with_error(file_description, error_message, current_content, model=MODEL_MAP["regenerate"]):
+    """Ask for the minimal line edits that fix a file and apply them, returning None if that fails."""
+    try:
+        numbered_content = "\n".join(f"{number}: {line}" for number, line in enumerate(current_content.splitlines(), start=1))
+        user_prompt = f"""
+        Please fix the file with the smallest possible set of line edits. Line numbers refer to the current content below.
+        Use "replace" to replace a line with the given text, "insert_after" to insert text after a line (0 inserts at the top),
+        and "delete" to remove a line. The text may span several lines and must not include line numbers.
+        
+        Current content of {file_description.file_name}:
+        {numbered_content}
+        
+        When trying to use {file_description.file_name}, the following error occurred:
+        ERROR: {error_message}
+        """
+        message_list = [CODE_SYSTEM_PROMPT, {"role": "user", "content": user_prompt}]
+        
+        patch = cached_parse_completion(message_list, model, FilePatch, max_tokens=MAX_TOKENS["patch"])
+        fixed_content = apply_line_patch(current_content, patch.edits)
+        if fixed_content is None or fixed_content == current_content:
+            logger.warning(f"Patch for {file_description.file_name} could not be applied")
+            return None
+        return fixed_content
+    except Exception as e:
+        logger.warning(f"Error patching {file_description.file_name}: {str(e)}")
+        return None
+
+def regenerate_file_with_error(file_description, error_message, sandbox, model=MODEL_MAP["regenerate"]):
     """Regenerate a file's content with error context."""
     try:
+        # Return the fix already produced for this exact error
+        regen_key = get_regeneration_key(sandbox, file_description.file_name, error_message)
+        if regen_key in _regen_cache:
+            print(f"Reusing regenerated content for {file_description.file_name}")
+            return _regen_cache[regen_key]
+        
         # Read the current file content to provide context
         current_content = ""
         try:
             current_content = sandbox.files.read(f"/home/user/{file_description.file_name}")
         except:
             pass  # File might not exist or be readable
-            
-        system_prompt = {
-        "role": "system",
-        "content": "You are a code generation assistant. ALWAYS output ONLY valid, runnable code. DO NOT include explanations, markdown formatting, backticks, or extra text. No introductions, summaries, or additional commentary."
-        }
+        
+        # A small patch is much cheaper than rewriting the whole file
+        if current_content:
+            fixed_content = patch_file_with_error(file_description, error_message, current_content, model)
+            if fixed_content:
+                _regen_cache[regen_key] = fixed_content
+                print(f"Patched {file_description.file_name} with error context")
+                return fixed_content
+        
+        system_prompt = CODE_SYSTEM_PROMPT
         message_list = [system_prompt]
         
+        # The error goes last so retries for the same file share the prompt prefix
         user_prompt = f"""
-        The file {file_description.file_name} needs to be fixed. When trying to use it, the following error occurred:
-        
-        ERROR: {error_message}
+        Please fix the file and provide the corrected version. ALWAYS output ONLY valid, runnable code. DO NOT include explanations, markdown formatting, backticks, or extra text. No introductions, summaries, or additional commentary.
         
-        Current file content:
+        Current content of {file_description.file_name}:
         {current_content}
         
-        Please fix the file and provide the corrected version. ALWAYS output ONLY valid, runnable code. DO NOT include explanations, markdown formatting, backticks, or extra text. No introductions, summaries, or additional commentary.
+        When trying to use {file_description.file_name}, the following error occurred:
+        ERROR: {error_message}
         """
         
         message_list.append({"role": "user", "content": user_prompt})
         
-        completion = client.chat.completions.create(
-            model="gpt-4o",
-            messages=message_list
-        )
-        
-        fixed_content = completion.choices[0].message.content
+        fixed_content = cached_chat_completion(message_list, model, max_tokens=max_tokens_for_file(file_description.file_name))
+        if fixed_content:
+            _regen_cache[regen_key] = fixed_content
         print(f"Regenerated content for {file_description.file_name} with error context")
         return fixed_content
     except Exception as e:
@@ -517,39 +1323,35 @@ def regenerate_file_with_error(file_description, error_message, sandbox):
         return None
 
 def stop_website_server(website_info):
-    """Stop the running website server."""
+    """Stop the running website server and return its sandbox to the pool."""
     if website_info and "process" in website_info:
         website_info["process"].kill()
         print("Website server stopped")
+    if website_info and website_info.get("sandbox"):
+        release_sandbox(website_info["sandbox"])
 
 # Add a new function to check logs when errors occur
 def check_sandbox_logs(sandbox):
     """Check the logs in the sandbox to diagnose errors."""
+    _init_logging()
     try:
         logger.info("Checking sandbox logs for diagnostic information...")
         
-        # Try to find and log any log files
-        log_cmd = sandbox.commands.run("find /home/user -name '*.log' -type f -exec cat {} \\; 2>/dev/null || echo 'No log files found'")
-        logger.info(f"Log files content:\n{log_cmd.stdout}")
-        
-        # Check running processes
-        processes = sandbox.commands.run("ps aux")
-        logger.info(f"Running processes:\n{processes.stdout}")
-        
-        # Check system errors
-        stderr = sandbox.commands.run("dmesg | tail -n 50")
-        logger.info(f"System logs:\n{stderr.stdout}")
-        
-        # Check Python traceback files if any
-        traceback_files = sandbox.commands.run("find /home/user -name '*.err' -o -name '*.traceback' -type f -exec cat {} \\; 2>/dev/null || echo 'No error files found'")
-        logger.info(f"Traceback files:\n{traceback_files.stdout}")
+        # Run every diagnostic in one command, separating the outputs with markers
+        script = "; ".join(
+            f"echo '{DIAGNOSTIC_MARKER}{index}'; ({command})"
+            for index, (_, command) in enumerate(DIAGNOSTIC_COMMANDS)
+        ) + "; true"
+        result = sandbox.commands.run(script)
         
-        # Try to get Flask app error information
-        flask_errors = sandbox.commands.run("cd /home/user && python -c 'import traceback; print(traceback.format_exc())' 2>/dev/null || echo 'No Python traceback available'")
-        logger.info(f"Flask error traceback:\n{flask_errors.stdout}")
+        # Splitting multi-KB diagnostics is wasted work when INFO records are dropped
+        if logger.isEnabledFor(logging.INFO):
+            sections = re.split(rf"^{re.escape(DIAGNOSTIC_MARKER)}(\d+)\n", result.stdout, flags=re.MULTILINE)
+            for index, output in zip(sections[1::2], sections[2::2]):
+                title = DIAGNOSTIC_COMMANDS[int(index)][0]
+                logger.info("%s:\n%s", title, output)
         
         return True
     except Exception as e:
-        error_details = traceback.format_exc()
-        logger.error(f"Error checking logs: {str(e)}\n{error_details}")
-        return False
\ No newline at end of file
+        logger.error("Error checking logs: %s", e, exc_info=True)
+        return False
@@ -0,0 +1,105 @@
+import os
+import orjson
+import hashlib
+import math
+import sqlite3
+import tempfile
+import time
+from contextlib import closing
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Directory where LLM responses are cached between runs
+CACHE_DIRECTORY = os.getenv("DEPLOYBOT_CACHE_DIR", os.path.expanduser("~/.cache/deploybot"))
+
+# Set DEPLOYBOT_DISABLE_CACHE=1 to bypass every cache and always call the API
+CACHE_DISABLED = os.getenv("DEPLOYBOT_DISABLE_CACHE", "").lower() in ("1", "true", "yes")
+
+# SQLite database holding responses keyed by prompt embeddings
+SEMANTIC_CACHE_PATH = os.path.join(CACHE_DIRECTORY, "semantic_cache.db")
+
+def get_cache_key(messages, model, **params):
+    """Compute a content-addressed cache key for a chat completion request."""
+    payload = orjson.dumps({"messages": messages, "params": params}, option=orjson.OPT_SORT_KEYS, default=str)
+    return hashlib.sha256(payload + model.encode("utf-8")).hexdigest()
+
+def get_bundle_key(website_description, version=""):
+    """Compute the cache key for a complete generated site, built by the given generator version."""
+    return hashlib.sha256(f"bundle:{version}:{website_description}".encode("utf-8")).hexdigest()
+
+def read_cached_response(key):
+    """Return the cached response content for a key, or None on a miss."""
+    if CACHE_DISABLED:
+        return None
+    cache_path = os.path.join(CACHE_DIRECTORY, f"{key}.json")
+    try:
+        with open(cache_path, "rb") as f:
+            return orjson.loads(f.read())["content"]
+    except (OSError, ValueError, KeyError):
+        return None
+
+def write_cached_response(key, content):
+    """Store response content under a key."""
+    if CACHE_DISABLED:
+        return
+    try:
+        os.makedirs(CACHE_DIRECTORY, exist_ok=True)
+        # Write to a temporary file first so concurrent readers never see a partial entry
+        with tempfile.NamedTemporaryFile("wb", dir=CACHE_DIRECTORY, suffix=".tmp", delete=False) as f:
+            f.write(orjson.dumps({"content": content}))
+        os.replace(f.name, os.path.join(CACHE_DIRECTORY, f"{key}.json"))
+    except OSError as e:
+        print(f"Error writing cache entry {key}: {e}")
+
+def _connect_semantic_cache():
+    """Open the semantic cache database, creating it if needed."""
+    os.makedirs(CACHE_DIRECTORY, exist_ok=True)
+    connection = sqlite3.connect(SEMANTIC_CACHE_PATH)
+    connection.execute(
+        "CREATE TABLE IF NOT EXISTS entries (namespace TEXT, embedding TEXT, content TEXT, created_at REAL)"
+    )
+    connection.execute("CREATE INDEX IF NOT EXISTS entries_namespace ON entries (namespace, created_at)")
+    return connection
+
+def cosine_similarity(a, b):
+    """Cosine similarity between two vectors."""
+    dot = sum(x * y for x, y in zip(a, b))
+    norm = math.sqrt(sum(x * x for x in a)) * math.sqrt(sum(y * y for y in b))
+    return dot / norm if norm else 0.0
+
+def read_semantic_cache(namespace, embedding, threshold, ttl):
+    """Return the content of the most similar fresh entry above the threshold, or None."""
+    if CACHE_DISABLED:
+        return None
+    try:
+        with closing(_connect_semantic_cache()) as connection:
+            rows = connection.execute(
+                "SELECT embedding, content FROM entries WHERE namespace = ? AND created_at >= ?",
+                (namespace, time.time() - ttl)
+            ).fetchall()
+    except sqlite3.Error as e:
+        print(f"Error reading semantic cache: {e}")
+        return None
+    
+    best_score, best_content = threshold, None
+    for stored_embedding, content in rows:
+        score = cosine_similarity(embedding, orjson.loads(stored_embedding))
+        if score >= best_score:
+            best_score, best_content = score, content
+    return best_content
+
+def write_semantic_cache(namespace, embedding, content, ttl=None):
+    """Store response content under its prompt embedding, deleting entries older than ttl seconds."""
+    if CACHE_DISABLED:
+        return
+    try:
+        with closing(_connect_semantic_cache()) as connection, connection:
+            if ttl is not None:
+                connection.execute("DELETE FROM entries WHERE created_at < ?", (time.time() - ttl,))
+            connection.execute(
+                "INSERT INTO entries (namespace, embedding, content, created_at) VALUES (?, ?, ?, ?)",
+                (namespace, orjson.dumps(embedding), content, time.time())
+            )
+    except sqlite3.Error as e:
+        print(f"Error writing semantic cache: {e}")
@@ -1,11 +1,15 @@
 #!/usr/bin/env python3
 
 import os
+import shlex
+import socket
+import tarfile
 import time
 import boto3
 import paramiko
 import dotenv
 from pathlib import Path
+from botocore.config import Config
 from botocore.exceptions import ClientError
 from dotenv import load_dotenv
 
@@ -17,6 +21,13 @@ AWS_ACCESS_KEY_ID = os.getenv('AWS_ACCESS_KEY_ID')
 AWS_SECRET_ACCESS_KEY = os.getenv('AWS_SECRET_ACCESS_KEY')
 AWS_REGION = os.getenv('AWS_REGION', 'us-east-1')  # Default to us-east-1 if not specified
 
+# Retry throttled calls adaptively and keep API connections alive between calls
+AWS_CONFIG = Config(
+    retries={'mode': 'adaptive', 'max_attempts': 6},
+    tcp_keepalive=True,
+    max_pool_connections=20
+)
+
 # EC2 configuration
 INSTANCE_TYPE = 't2.micro'  # Free tier eligible instance type
 
@@ -31,48 +42,99 @@ INSTANCE_NAME = 'deploybot-server'  # Name tag for the EC2 instance
 APP_DIR = '/home/ubuntu/deploybot'
 SERVICE_NAME = 'deploybot'
 
+# uv installs to ~/.local/bin; expanded by the remote shell
+UV_BIN = '$HOME/.local/bin/uv'
+REMOTE_REQUIREMENTS = '/tmp/deploybot-requirements.txt'
+
+# Local files shipped to the instance
+DEPLOY_EXTENSIONS = {'.py', '.txt'}
+DEPLOY_FILES = {'.env'}
+DEPLOY_EXCLUDED_FILES = {'deploy_to_ec2.py'}
+DEPLOY_SKIP_DIRS = {'.git', '__pycache__', 'temp', 'venv'}
+
+def get_desired_ip_permissions():
+    """Build the inbound rules the application's security group should have."""
+    ip_permissions = [
+        # SSH from anywhere for administration
+        {
+            'IpProtocol': 'tcp',
+            'FromPort': 22,
+            'ToPort': 22,
+            'IpRanges': [{'CidrIp': '0.0.0.0/0'}]
+        }
+    ]
+    
+    # Add restricted access for HTTP, HTTPS and application port
+    for port in [80, 443, 8000]:
+        permission = {
+            'IpProtocol': 'tcp',
+            'FromPort': port,
+            'ToPort': port,
+            'IpRanges': [{'CidrIp': ip} for ip in ALLOWED_IPS]
+        }
+        ip_permissions.append(permission)
+    
+    return ip_permissions
+
+def canonicalize_ip_permissions(ip_permissions):
+    """Flatten IpPermissions into a set of (protocol, from_port, to_port, range_type, cidr) rules."""
+    rules = set()
+    for permission in ip_permissions:
+        for range_type, cidr_key in (('IpRanges', 'CidrIp'), ('Ipv6Ranges', 'CidrIpv6')):
+            for ip_range in permission.get(range_type, []):
+                rules.add((
+                    permission['IpProtocol'],
+                    permission.get('FromPort'),
+                    permission.get('ToPort'),
+                    range_type,
+                    ip_range[cidr_key]
+                ))
+    return rules
+
+def rules_to_ip_permissions(rules):
+    """Convert canonical rules back into the IpPermissions format EC2 expects."""
+    ip_permissions = []
+    for protocol, from_port, to_port, range_type, cidr in sorted(rules, key=str):
+        permission = {'IpProtocol': protocol}
+        if from_port is not None:
+            permission['FromPort'] = from_port
+            permission['ToPort'] = to_port
+        cidr_key = 'CidrIp' if range_type == 'IpRanges' else 'CidrIpv6'
+        permission[range_type] = [{cidr_key: cidr}]
+        ip_permissions.append(permission)
+    return ip_permissions
+
 def get_or_create_security_group(ec2_client):
     """Get or create a security group for the application."""
+    desired_rules = canonicalize_ip_permissions(get_desired_ip_permissions())
+    
     try:
         response = ec2_client.describe_security_groups(
             GroupNames=[SECURITY_GROUP_NAME]
         )
-        security_group_id = response['SecurityGroups'][0]['GroupId']
-        
-        # Update the existing security group with new rules
-        print(f"Updating security group rules for: {SECURITY_GROUP_NAME}")
+        security_group = response['SecurityGroups'][0]
+        security_group_id = security_group['GroupId']
         
-        # First revoke all existing inbound rules
-        ec2_client.revoke_security_group_ingress(
-            GroupId=security_group_id,
-            IpPermissions=response['SecurityGroups'][0].get('IpPermissions', [])
-        )
+        # Only touch the rules that differ from what we want
+        current_rules = canonicalize_ip_permissions(security_group.get('IpPermissions', []))
+        to_remove = current_rules - desired_rules
+        to_add = desired_rules - current_rules
         
-        # Add new rules
-        ip_permissions = [
-            # SSH from anywhere for administration
-            {
-                'IpProtocol': 'tcp',
-                'FromPort': 22,
-                'ToPort': 22,
-                'IpRanges': [{'CidrIp': '0.0.0.0/0'}]
-            }
-        ]
+        if not to_remove and not to_add:
+            print(f"Security group rules for {SECURITY_GROUP_NAME} are up to date")
+            return security_group_id
         
-        # Add restricted access for HTTP, HTTPS and application port
-        for port in [80, 443, 8000]:
-            permission = {
-                'IpProtocol': 'tcp',
-                'FromPort': port,
-                'ToPort': port,
-                'IpRanges': [{'CidrIp': ip} for ip in ALLOWED_IPS]
-            }
-            ip_permissions.append(permission)
-            
-        ec2_client.authorize_security_group_ingress(
-            GroupId=security_group_id,
-            IpPermissions=ip_permissions
-        )
+        print(f"Updating security group rules for: {SECURITY_GROUP_NAME}")
+        if to_remove:
+            ec2_client.revoke_security_group_ingress(
+                GroupId=security_group_id,
+                IpPermissions=rules_to_ip_permissions(to_remove)
+            )
+        if to_add:
+            ec2_client.authorize_security_group_ingress(
+                GroupId=security_group_id,
+                IpPermissions=rules_to_ip_permissions(to_add)
+            )
         
         return security_group_id
     except ClientError as e:
@@ -86,29 +148,9 @@ def get_or_create_security_group(ec2_client):
             security_group_id = response['GroupId']
             
             # Add inbound rules
-            ip_permissions = [
-                # SSH from anywhere for administration
-                {
-                    'IpProtocol': 'tcp',
-                    'FromPort': 22,
-                    'ToPort': 22,
-                    'IpRanges': [{'CidrIp': '0.0.0.0/0'}]
-                }
-            ]
-            
-            # Add restricted access for HTTP, HTTPS and application port
-            for port in [80, 443, 8000]:
-                permission = {
-                    'IpProtocol': 'tcp',
-                    'FromPort': port,
-                    'ToPort': port,
-                    'IpRanges': [{'CidrIp': ip} for ip in ALLOWED_IPS]
-                }
-                ip_permissions.append(permission)
-                
             ec2_client.authorize_security_group_ingress(
                 GroupId=security_group_id,
-                IpPermissions=ip_permissions
+                IpPermissions=get_desired_ip_permissions()
             )
             
             return security_group_id
@@ -147,18 +189,23 @@ def get_or_create_key_pair(ec2_client):
 
 def get_or_launch_instance(ec2_resource, security_group_id):
     """Get an existing instance or launch a new one."""
-    # Check for existing instances with the tag
-    instances = list(ec2_resource.instances.filter(
+    # Check for existing instances with the tag, filtered server-side; a filtered page can come back
+    # empty with more results behind it, so keep paging until a match or the last page
+    paginator = ec2_resource.meta.client.get_paginator('describe_instances')
+    pages = paginator.paginate(
         Filters=[
             {'Name': 'tag:Name', 'Values': [INSTANCE_NAME]},
             {'Name': 'instance-state-name', 'Values': ['running', 'pending']}
-        ]
-    ))
+        ],
+        PaginationConfig={'PageSize': 5}
+    )
     
-    if instances:
-        instance = instances[0]
-        print(f"Found existing instance: {instance.id}")
-        return instance
+    for page in pages:
+        for reservation in page['Reservations']:
+            for found in reservation['Instances']:
+                instance = ec2_resource.Instance(found['InstanceId'])
+                print(f"Found existing instance: {instance.id}")
+                return instance
     
     # Launch a new instance
     print(f"Launching new EC2 instance: {INSTANCE_NAME}")
@@ -184,46 +231,73 @@ def get_or_launch_instance(ec2_resource, security_group_id):
     
     return instance
 
-def wait_for_ssh(hostname, retries=10, delay=15):
-    """Wait for SSH to become available on the instance."""
+def wait_for_ssh(hostname, timeout=150, max_delay=30):
+    """Wait for SSH to become available on the instance and return the connected client, or None."""
     ssh = paramiko.SSHClient()
     ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
     
-    for i in range(retries):
+    deadline = time.monotonic() + timeout
+    delay = 1
+    attempt = 0
+    while time.monotonic() < deadline:
+        attempt += 1
         try:
-            print(f"Trying to connect via SSH (attempt {i+1}/{retries})...")
+            # Probe the port first so we only pay for a full SSH handshake once it answers
+            with socket.create_connection((hostname, 22), timeout=3):
+                pass
+            print(f"Trying to connect via SSH (attempt {attempt})...")
             ssh.connect(
                 hostname=hostname,
                 username='ubuntu',
                 key_filename=f"{KEY_NAME}.pem",
-                timeout=10
+                timeout=10,
+                banner_timeout=10,
+                auth_timeout=10,
+                # We always pass the key file, so skip probing ~/.ssh and the agent
+                look_for_keys=False,
+                allow_agent=False
             )
             print("SSH connection successful!")
-            ssh.close()
-            return True
+            # Keep the connection alive so setup and deployment can reuse it
+            ssh.get_transport().set_keepalive(30)
+            return ssh
         except Exception as e:
-            print(f"SSH connection failed: {e}")
-            if i < retries - 1:
-                print(f"Waiting {delay} seconds before next attempt...")
-                time.sleep(delay)
+            print(f"SSH not ready yet: {e}")
+            print(f"Waiting {delay} seconds before next attempt...")
+            time.sleep(min(delay, max(deadline - time.monotonic(), 0)))
+            delay = min(delay * 2, max_delay)
     
     print("Failed to establish SSH connection after multiple attempts.")
-    return False
+    ssh.close()
+    return None
 
-def setup_instance(hostname):
-    """Set up the EC2 instance with required packages and configurations."""
-    ssh = paramiko.SSHClient()
-    ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-    ssh.connect(
-        hostname=hostname,
-        username='ubuntu',
-        key_filename=f"{KEY_NAME}.pem"
-    )
+def run_remote_commands(ssh, commands):
+    """Run shell commands as one script over a single SSH channel, continuing past failures."""
+    # Each command runs in its own subshell so a failing step or a `cd` does not leak into the next one,
+    # with stdin from /dev/null so a step that reads input can't swallow the rest of the script
+    script = ["exec 2>&1"]
+    for cmd in commands:
+        script.append(f"printf 'Running: %s\\n' {shlex.quote(cmd)}")
+        script.append(f"(\n{cmd}\n) < /dev/null")
+        script.append('status=$?; [ $status -eq 0 ] || echo "Error executing command (exit status $status), continuing..."')
+    
+    stdin, stdout, stderr = ssh.exec_command("bash -s")
+    stdin.write("\n".join(script) + "\n")
+    stdin.channel.shutdown_write()
     
+    # Stream output line by line to keep per-step logging
+    for line in iter(stdout.readline, ""):
+        print(line, end="")
+    return stdout.channel.recv_exit_status()
+
+def setup_instance(ssh):
+    """Set up the EC2 instance with required packages and configurations."""
     # Update package lists and install dependencies
     commands = [
         "sudo apt-get update",
         "sudo apt-get install -y python3-pip python3-venv nginx",
+        # Install uv for fast dependency installs
+        f"test -x {UV_BIN} || curl -LsSf https://astral.sh/uv/install.sh | sh",
         f"mkdir -p {APP_DIR}",
         # Setup systemd service
         f"""sudo bash -c 'cat > /etc/systemd/system/{SERVICE_NAME}.service << EOF
@@ -264,79 +338,42 @@ EOF'""",
         "sudo systemctl enable " + SERVICE_NAME
     ]
     
-    for cmd in commands:
-        print(f"Running: {cmd}")
-        stdin, stdout, stderr = ssh.exec_command(cmd)
-        exit_status = stdout.channel.recv_exit_status()
-        if exit_status != 0:
-            print(f"Error executing command: {stderr.read().decode()}")
-    
-    ssh.close()
+    run_remote_commands(ssh, commands)
     print("Instance setup completed successfully.")
 
-def deploy_application(hostname):
-    """Deploy the application code to the EC2 instance."""
-    ssh = paramiko.SSHClient()
-    ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-    ssh.connect(
-        hostname=hostname,
-        username='ubuntu',
-        key_filename=f"{KEY_NAME}.pem"
-    )
-    
-    # Create virtual environment if it doesn't exist
-    stdin, stdout, stderr = ssh.exec_command(f"test -d {APP_DIR}/venv || python3 -m venv {APP_DIR}/venv")
-    exit_status = stdout.channel.recv_exit_status()
-    
-    # Upload application files using SFTP
-    sftp = ssh.open_sftp()
-    
-    # Get list of local files to upload (excluding .git, __pycache__, etc.)
-    local_files = []
-    for root, dirs, files in os.walk('.'):
-        # Skip certain directories
-        dirs[:] = [d for d in dirs if d not in ['.git', '__pycache__', 'temp', 'venv']]
+def iter_deploy_files(root_dir='.'):
+    """Yield the relative paths of local files to upload (excluding .git, __pycache__, etc.)."""
+    for root, dirs, files in os.walk(root_dir):
+        # Prune skipped directories so their trees are never walked
+        dirs[:] = [d for d in dirs if d not in DEPLOY_SKIP_DIRS]
         
         for file in files:
-            if file.endswith(('.py', '.txt')) or file == '.env':
-                if file == 'deploy_to_ec2.py':
-                    continue
+            path = Path(root, file)
+            if (path.suffix in DEPLOY_EXTENSIONS or file in DEPLOY_FILES) and file not in DEPLOY_EXCLUDED_FILES:
+                yield str(path.relative_to(root_dir))
 
-                local_path = os.path.join(root, file)
-                # Convert to relative path
-                rel_path = os.path.relpath(local_path, '.')
-                local_files.append(rel_path)
-    
-    # Upload each file
-    for file_path in local_files:
-        remote_path = f"{APP_DIR}/{file_path}"
-        remote_dir = os.path.dirname(remote_path)
-        
-        # Create remote directory if it doesn't exist
-        try:
-            sftp.stat(remote_dir)
-        except FileNotFoundError:
-            stdin, stdout, stderr = ssh.exec_command(f"mkdir -p {remote_dir}")
-            stdout.channel.recv_exit_status()
-        
-        print(f"Uploading {file_path} to {remote_path}")
-        sftp.put(file_path, remote_path)
-    
-    sftp.close()
+def deploy_application(ssh):
+    """Deploy the application code to the EC2 instance."""
+    # Stream all files as one gzipped tar into the app directory over a single channel
+    stdin, stdout, stderr = ssh.exec_command(f"mkdir -p {APP_DIR} && tar -xzf - -C {APP_DIR}")
+    with tarfile.open(fileobj=stdin, mode="w|gz") as tar:
+        for file_path in iter_deploy_files():
+            print(f"Uploading {file_path} to {APP_DIR}/{file_path}")
+            tar.add(file_path, arcname=file_path)
+    stdin.channel.shutdown_write()
+    if stdout.channel.recv_exit_status() != 0:
+        print(f"Error uploading application files: {stderr.read().decode()}")
     
     # Install dependencies and restart service
     commands = [
-        # Upgrade pip first
-        f"{APP_DIR}/venv/bin/pip install --upgrade pip",
-        
-        # Install specific required packages first (uvicorn, fastapi, etc.)
-        f"{APP_DIR}/venv/bin/pip install uvicorn fastapi",
+        # Create virtual environment if it doesn't exist
+        f"test -d {APP_DIR}/venv || {UV_BIN} venv {APP_DIR}/venv",
         
-        # Install from requirements.txt
-        f"{APP_DIR}/venv/bin/pip install -r {APP_DIR}/requirements.txt",
-        
-        # Additional fallback for packages that might have specific constraints
-        f"cd {APP_DIR} && source venv/bin/activate && grep -v '@' requirements.txt | cut -d= -f1 | xargs pip install",
+        # Install uvicorn, fastapi and requirements.txt in one resolve, skipping local "@ file://" entries;
+        # fall back to unpinned names for packages that might have specific constraints
+        f"cd {APP_DIR} && grep -v '@' requirements.txt > {REMOTE_REQUIREMENTS} && "
+        f"({UV_BIN} pip install --python venv/bin/python uvicorn fastapi -r {REMOTE_REQUIREMENTS} || "
+        f"cut -d= -f1 {REMOTE_REQUIREMENTS} | xargs {UV_BIN} pip install --python venv/bin/python uvicorn fastapi)",
         
         # Reset any failed service attempts
         "sudo systemctl reset-failed " + SERVICE_NAME,
@@ -351,20 +388,8 @@ def deploy_application(hostname):
         "sudo systemctl status " + SERVICE_NAME
     ]
     
-    for cmd in commands:
-        print(f"Running: {cmd}")
-        stdin, stdout, stderr = ssh.exec_command(cmd)
-        exit_status = stdout.channel.recv_exit_status()
-        if exit_status != 0:
-            error_output = stderr.read().decode()
-            print(f"Error executing command: {error_output}")
-            # Continue with other commands rather than stopping deployment on first error
-            print("Continuing with deployment despite error...")
-        else:
-            success_output = stdout.read().decode()
-            print(f"Command output: {success_output[:500]}..." if len(success_output) > 500 else f"Command output: {success_output}")
-    
-    ssh.close()
+    # Continue with other commands rather than stopping deployment on first error
+    run_remote_commands(ssh, commands)
     print("Application deployed successfully!")
 
 def main():
@@ -372,21 +397,16 @@ def main():
     if not AWS_ACCESS_KEY_ID or not AWS_SECRET_ACCESS_KEY:
         raise ValueError("AWS credentials not found. Make sure AWS_ACCESS_KEY_ID and AWS_SECRET_ACCESS_KEY are set in .env file.")
     
-    # Initialize AWS clients
+    # Initialize AWS clients from one session so they share credentials and configuration
     try:
-        ec2_client = boto3.client(
-            'ec2',
-            region_name=AWS_REGION,
-            aws_access_key_id=AWS_ACCESS_KEY_ID,
-            aws_secret_access_key=AWS_SECRET_ACCESS_KEY
-        )
-        
-        ec2_resource = boto3.resource(
-            'ec2',
+        session = boto3.Session(
             region_name=AWS_REGION,
             aws_access_key_id=AWS_ACCESS_KEY_ID,
             aws_secret_access_key=AWS_SECRET_ACCESS_KEY
         )
+        ec2_resource = session.resource('ec2', config=AWS_CONFIG)
+        # Use the resource's client so both share one connection pool
+        ec2_client = ec2_resource.meta.client
     except Exception as e:
         print(f"Error connecting to AWS: {e}")
         return
@@ -406,12 +426,16 @@ def main():
         print(f"Public IP: {instance.public_ip_address}")
         
         # Wait for SSH to become available
-        if wait_for_ssh(instance.public_dns_name):
-            # Set up the instance
-            setup_instance(instance.public_dns_name)
-            
-            # Deploy the application
-            deploy_application(instance.public_dns_name)
+        ssh = wait_for_ssh(instance.public_dns_name)
+        if ssh:
+            try:
+                # Set up the instance
+                setup_instance(ssh)
+                
+                # Deploy the application over the same connection
+                deploy_application(ssh)
+            finally:
+                ssh.close()
             
             print("\nDeployment completed successfully!")
             print(f"Your application is now running at: http://{instance.public_ip_address}")
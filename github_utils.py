@@ -1,42 +1,96 @@
 import os
-from github import Github, GithubException
+import asyncio
+import base64
+import httpx
+from github import Auth, Github, GithubException, InputGitTreeElement
 from dotenv import load_dotenv
 import re
 import subprocess
+import threading
 import time
+from contextlib import contextmanager
+from functools import lru_cache
+
+# File locks shared between worker processes aren't available on Windows
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 load_dotenv()
 
 GITHUB_TOKEN = os.getenv("GITHUB_TOKEN")
 
-# Initialize clients
-github_client = Github(GITHUB_TOKEN)
+# Initialize clients; one pooled client is shared by every request so API calls reuse connections
+GITHUB_POOL_SIZE = 32
+github_client = Github(
+    auth=Auth.Token(GITHUB_TOKEN) if GITHUB_TOKEN else None,
+    per_page=100,
+    pool_size=GITHUB_POOL_SIZE
+)
+
+# Binary files committed through the API are uploaded as blobs, this many at a time over one HTTP/2 connection
+GITHUB_API_URL = "https://api.github.com"
+BLOB_UPLOAD_CONCURRENCY = 8
+
+# Matches owner/repo in a GitHub URL, ignoring a trailing .git or sub-path
+REPO_URL_PATTERN = re.compile(r"https?://github\.com/([^/]+)/([^/]+?)(?:\.git)?(?:/|$)")
+
+# Bare mirrors of cloned repositories, refreshed with an incremental fetch per build. Each mirror is
+# guarded by a thread lock and a <mirror>.lock file lock, so several server workers can share them
+MIRROR_DIRECTORY = os.getenv("DEPLOYBOT_MIRROR_DIR", os.path.expanduser("~/.cache/deploybot/mirrors"))
+_mirror_locks = {}
+
+# Repository lookups are reused for this many seconds
+REPO_CACHE_TTL = 900
+REPO_CACHE_SIZE = 128
+_repo_cache = {}
+_repo_cache_lock = threading.Lock()
 
 def parse_repo_url(repo_url):
     """Extract owner and repo name from GitHub URL."""
-    pattern = r"https?://github\.com/([^/]+)/([^/]+)"
-    match = re.match(pattern, repo_url)
+    match = REPO_URL_PATTERN.match(repo_url)
     if match:
         owner, repo_name = match.groups()
         return f"{owner}/{repo_name}"
     else:
         raise ValueError(f"Invalid GitHub repository URL: {repo_url}")
 
+@lru_cache(maxsize=1)
+def get_authenticated_user():
+    """Return the authenticated GitHub user, fetched once per process."""
+    return github_client.get_user()
+
 def get_repository(repo_full_name):
-    """Get a repository object from GitHub."""
-    return github_client.get_repo(repo_full_name)
+    """Get a repository object from GitHub, reusing recent lookups."""
+    with _repo_cache_lock:
+        cached = _repo_cache.get(repo_full_name)
+    if cached and time.monotonic() - cached[0] < REPO_CACHE_TTL:
+        return cached[1]
+    
+    # Fetch outside the lock so a slow lookup doesn't block other repositories
+    repo = github_client.get_repo(repo_full_name)
+    with _repo_cache_lock:
+        # Drop the oldest entry once the cache is full
+        if repo_full_name not in _repo_cache and len(_repo_cache) >= REPO_CACHE_SIZE:
+            _repo_cache.pop(next(iter(_repo_cache)), None)
+        _repo_cache[repo_full_name] = (time.monotonic(), repo)
+    return repo
 
 def fork_repository(repo):
     """Fork the repository to the authenticated user's account."""
     try:
         # Get the authenticated user
-        user = github_client.get_user()
+        user = get_authenticated_user()
         
-        # Check if a fork already exists
-        for fork in repo.get_forks():
-            if fork.owner.login == user.login:
+        # Check if a fork already exists under the user's account
+        try:
+            fork = github_client.get_repo(f"{user.login}/{repo.name}")
+            if fork.fork and fork.parent and fork.parent.full_name == repo.full_name:
                 print(f"Using existing fork: {fork.html_url}")
                 return fork
+        except GithubException:
+            pass
         
         # Create a new fork
         fork = user.create_fork(repo)
@@ -50,42 +104,201 @@ def fork_repository(repo):
         print(f"Error forking repository: {e}")
         return None
 
-def clone_repository(repo_url, local_path, use_fork=True):
-    """Clone the repository to a local directory."""
+def authenticated_url(repo_url):
+    """Include the token in a GitHub URL for authentication."""
+    if GITHUB_TOKEN and "https://github.com" in repo_url:
+        return repo_url.replace("https://github.com", f"https://{GITHUB_TOKEN}@github.com")
+    return repo_url
+
+def mirror_path_for(repo_url):
+    """Path of the local bare mirror for a GitHub repository URL."""
+    return os.path.join(MIRROR_DIRECTORY, parse_repo_url(repo_url).replace("/", "_") + ".git")
+
+@contextmanager
+def mirror_lock(mirror_path):
+    """Hold a mirror's lock against other threads and, where fcntl is available, other worker processes."""
+    with _mirror_locks.setdefault(mirror_path, threading.Lock()):
+        os.makedirs(MIRROR_DIRECTORY, exist_ok=True)
+        if fcntl is None:
+            yield
+            return
+        with open(f"{mirror_path}.lock", "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            yield
+
+def update_mirror(repo_url):
+    """Create or refresh the local bare mirror of a repository and return its path, or None."""
     try:
-        # If use_fork is True, fork the repository first and clone the fork instead
-        if use_fork:
-            repo_full_name = parse_repo_url(repo_url)
-            original_repo = get_repository(repo_full_name)
-            forked_repo = fork_repository(original_repo)
-            
-            if forked_repo:
-                # Use the forked repo URL
-                repo_url = forked_repo.clone_url
-                print(f"Using forked repository: {repo_url}")
+        mirror_path = mirror_path_for(repo_url)
+    except ValueError:
+        return None
+    
+    # Serialize fetches into the same mirror
+    try:
+        with mirror_lock(mirror_path):
+            if not os.path.isdir(mirror_path):
+                subprocess.run(["git", "clone", "--quiet", "--bare", authenticated_url(repo_url), mirror_path], check=True)
+                # Don't keep the token in the mirror's config
+                subprocess.run(["git", "-C", mirror_path, "remote", "set-url", "origin", repo_url], check=True)
             else:
-                print("Failed to fork repository, falling back to original repo")
-        
-        # Include token in the URL for authentication
-        if GITHUB_TOKEN and "https://github.com" in repo_url:
-            auth_repo_url = repo_url.replace("https://github.com", f"https://{GITHUB_TOKEN}@github.com")
-        else:
-            auth_repo_url = repo_url
+                # Pass the authenticated URL on the command line so the token is never stored
+                subprocess.run(
+                    ["git", "-C", mirror_path, "fetch", "--quiet", "--prune", authenticated_url(repo_url), "+refs/heads/*:refs/heads/*"],
+                    check=True
+                )
+        return mirror_path
+    except (OSError, subprocess.CalledProcessError) as e:
+        print(f"Error updating mirror for {repo_url}: {e}")
+        return None
+
+def resolve_clone_url(repo_url, use_fork=True):
+    """Return the URL to clone and push to, forking the repository first if use_fork is True."""
+    if not use_fork:
+        return repo_url
+    
+    repo_full_name = parse_repo_url(repo_url)
+    original_repo = get_repository(repo_full_name)
+    forked_repo = fork_repository(original_repo)
+    
+    if forked_repo:
+        # Use the forked repo URL
+        print(f"Using forked repository: {forked_repo.clone_url}")
+        return forked_repo.clone_url
+    
+    print("Failed to fork repository, falling back to original repo")
+    return repo_url
+
+def prepare_mirror(repo_url, use_fork=True, with_mirror=True):
+    """Fork the repository if needed and refresh its local mirror; return the URL to push to, or None.
+    
+    With with_mirror=False the mirror is skipped, for pushes made through the GitHub API.
+    """
+    try:
+        repo_url = resolve_clone_url(repo_url, use_fork)
+    except (ValueError, GithubException) as e:
+        print(f"Error preparing repository: {e}")
+        return None
+    if not with_mirror:
+        return repo_url
+    return repo_url if update_mirror(repo_url) else None
+
+def _quote_path(path):
+    """Quote a path for a git fast-import command."""
+    escaped = path.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return f'"{escaped}"'
+
+def commit_files_to_branch(repo_url, branch_name, files, commit_message, base_branch="main"):
+    """Commit files on top of the base branch in the local mirror and push them as a new branch.
+    
+    files is an iterable of (path, mode, content) tuples; no working copy is checked out.
+    """
+    try:
+        mirror_path = mirror_path_for(repo_url)
+        import_ref = f"refs/deploybot/{branch_name}"
+        try:
+            with mirror_lock(mirror_path):
+                # Write the blobs, tree and commit straight into the mirror's object store, under a ref
+                # outside refs/heads so a concurrent pruning fetch can't delete it before it is pushed
+                importer = subprocess.Popen(["git", "-C", mirror_path, "fast-import", "--quiet", "--force"], stdin=subprocess.PIPE)
+                message = commit_message.encode("utf-8")
+                try:
+                    importer.stdin.write(
+                        f"commit {import_ref}\n"
+                        f"committer DeployBot <deploybot@example.com> {int(time.time())} +0000\n"
+                        f"data {len(message)}\n".encode("utf-8")
+                    )
+                    importer.stdin.write(message + b"\n")
+                    importer.stdin.write(f"from refs/heads/{base_branch}^0\n".encode("utf-8"))
+                    for path, mode, content in files:
+                        importer.stdin.write(f"M {mode:o} inline {_quote_path(path)}\ndata {len(content)}\n".encode("utf-8"))
+                        importer.stdin.write(content)
+                        importer.stdin.write(b"\n")
+                except BaseException:
+                    # Kill the importer so a partial file list is never committed
+                    importer.kill()
+                    importer.wait()
+                    raise
+                importer.stdin.close()
+                if importer.wait() != 0:
+                    raise subprocess.CalledProcessError(importer.returncode, "git fast-import")
             
-        subprocess.run(["git", "clone", auth_repo_url, local_path], check=True)
-        print(f"Repository cloned to {local_path}")
+            # Push the new branch from the mirror
+            subprocess.run(
+                ["git", "-C", mirror_path, "push", "--quiet", "--force", authenticated_url(repo_url), f"{import_ref}:refs/heads/{branch_name}"],
+                check=True
+            )
+            print(f"Changes committed and pushed to {branch_name} with message: {commit_message}")
+            return True
+        finally:
+            # The ref only exists to carry the commit to the push, drop it so the mirror doesn't keep the objects
+            subprocess.run(["git", "-C", mirror_path, "update-ref", "-d", import_ref], check=False)
+    except (ValueError, OSError, subprocess.CalledProcessError) as e:
+        print(f"Error committing and pushing changes: {e}")
+        return False
+
+async def upload_blobs(repo_full_name, contents):
+    """Create a blob for each content concurrently, returning their SHAs in the same order."""
+    headers = {"Accept": "application/vnd.github+json"}
+    if GITHUB_TOKEN:
+        headers["Authorization"] = f"Bearer {GITHUB_TOKEN}"
+    semaphore = asyncio.Semaphore(BLOB_UPLOAD_CONCURRENCY)
+    
+    async with httpx.AsyncClient(
+        base_url=GITHUB_API_URL,
+        http2=True,
+        headers=headers,
+        limits=httpx.Limits(max_connections=1, max_keepalive_connections=1),
+        timeout=30
+    ) as client:
+        async def upload(content):
+            async with semaphore:
+                response = await client.post(
+                    f"/repos/{repo_full_name}/git/blobs",
+                    json={"content": base64.b64encode(content).decode("ascii"), "encoding": "base64"}
+                )
+                response.raise_for_status()
+                return response.json()["sha"]
+        
+        return await asyncio.gather(*(upload(content) for content in contents))
+
+def commit_files_via_api(repo_url, branch_name, files, commit_message, base_branch="main"):
+    """Commit files on top of the base branch through the GitHub Git Data API, without any clone.
+    
+    files is an iterable of (path, mode, content) tuples.
+    """
+    try:
+        repo = get_repository(parse_repo_url(repo_url))
+        base_commit = repo.get_git_commit(repo.get_branch(base_branch).commit.sha)
         
-        # Configure Git to use the token for subsequent operations
-        subprocess.run(["git", "-C", local_path, "config", "user.name", "DeployBot"], check=True)
-        subprocess.run(["git", "-C", local_path, "config", "user.email", "deploybot@example.com"], check=True)
+        # Text files go inline in the tree request; only binary files need their own blob upload
+        elements = []
+        binary_files = []
+        for path, mode, content in files:
+            try:
+                elements.append(InputGitTreeElement(path, f"{mode:o}", "blob", content=content.decode("utf-8")))
+            except UnicodeDecodeError:
+                binary_files.append((path, mode, content))
         
-        if use_fork:
-            # Add the original repository as a remote called "upstream"
-            subprocess.run(["git", "-C", local_path, "remote", "add", "upstream", repo_url.replace("https://github.com", f"https://{GITHUB_TOKEN}@github.com")], check=True)
-            
+        if binary_files:
+            shas = asyncio.run(upload_blobs(repo.full_name, [content for _, _, content in binary_files]))
+            for (path, mode, _), sha in zip(binary_files, shas):
+                elements.append(InputGitTreeElement(path, f"{mode:o}", "blob", sha=sha))
+        
+        tree = repo.create_git_tree(elements, base_commit.tree) if elements else base_commit.tree
+        commit = repo.create_git_commit(commit_message, tree, [base_commit])
+        
+        # Point the branch at the new commit, creating it if needed
+        try:
+            repo.create_git_ref(f"refs/heads/{branch_name}", commit.sha)
+        except GithubException as e:
+            if e.status != 422:
+                raise
+            repo.get_git_ref(f"heads/{branch_name}").edit(commit.sha, force=True)
+        
+        print(f"Changes committed and pushed to {branch_name} with message: {commit_message}")
         return True
-    except subprocess.CalledProcessError as e:
-        print(f"Error cloning repository: {e}")
+    except (ValueError, OSError, GithubException, httpx.HTTPError) as e:
+        print(f"Error committing and pushing changes: {e}")
         return False
 
 def create_issue(repo, title, description):
@@ -98,44 +311,11 @@ def create_issue(repo, title, description):
         print(f"Error creating issue: {e}")
         return None
 
-def create_branch(local_path, branch_name, base_branch="main"):
-    """Create a new branch from the base branch."""
-    try:
-        # Make sure we're on the base branch and it's up to date
-        subprocess.run(["git", "-C", local_path, "checkout", base_branch], check=True)
-        subprocess.run(["git", "-C", local_path, "pull"], check=True)
-
-        # Create and checkout new branch
-        subprocess.run(["git", "-C", local_path, "checkout", "-b", branch_name], check=True)
-        print(f"Created and checked out branch: {branch_name}")
-        return True
-    except subprocess.CalledProcessError as e:
-        print(f"Error creating branch: {e}")
-        return False
-
-def commit_and_push_changes(local_path, commit_message):
-    """Commit and push changes to the remote repository."""
-    try:
-        # Stage all changes
-        subprocess.run(["git", "-C", local_path, "add", "."], check=True)
-
-        # Commit changes without GPG signing
-        subprocess.run(["git", "-C", local_path, "commit", "--no-gpg-sign", "-m", commit_message], check=True)
-
-        # Push changes to remote
-        subprocess.run(["git", "-C", local_path, "push", "--set-upstream", "origin", "HEAD"], check=True)
-
-        print(f"Changes committed and pushed with message: {commit_message}")
-        return True
-    except subprocess.CalledProcessError as e:
-        print(f"Error committing and pushing changes: {e}")
-        return False
-
 def create_pull_request(repo, branch_name, base_branch, title, body):
     """Create a pull request from the branch to the base branch."""
     try:
         # Get the authenticated user to determine the head branch name
-        user = github_client.get_user()
+        user = get_authenticated_user()
         
         # Format the head branch as username:branch_name
         head = f"{user.login}:{branch_name}"
@@ -1,105 +1,222 @@
 #!/usr/bin/env python3
 
-from e2b import FileType
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, BackgroundTasks
 from pydantic import BaseModel
 import uvicorn
 from typing import Optional
-import tempfile
+import tarfile
+import asyncio
+import io
 import os
+import hashlib
+import threading
+from concurrent.futures import Future
 
 from github_utils import (
     parse_repo_url,
-    clone_repository,
+    prepare_mirror,
     create_issue,
-    create_branch,
-    commit_and_push_changes,
+    commit_files_to_branch,
+    commit_files_via_api,
     create_pull_request,
     get_repository
 )
 from build_mvp_website import (
-    generate_website_in_sandbox,
+    agenerate_website_in_sandbox,
     run_website_in_sandbox,
     stop_website_server,
-    check_sandbox_logs
+    release_sandbox,
+    check_sandbox_logs,
+    run_async
 )
 
+# Where the generated site is packed inside the sandbox before downloading
+SANDBOX_ARCHIVE_PATH = "/tmp/deploybot-site.tar.gz"
+
+# Set DEPLOYBOT_PUSH_VIA_API=1 to commit through the GitHub API instead of a local repository mirror
+PUSH_VIA_API = os.getenv("DEPLOYBOT_PUSH_VIA_API", "").lower() in ("1", "true", "yes")
+
+# Issue and pull request bodies, built once at import so each request only fills in the fields
+ISSUE_BODY_TEMPLATE = """# Build MVP Website
+
+## Description
+{description}
+
+## Requirements
+- Create a simple Flask app
+- Implement the website according to the description
+"""
+
+PR_HEADER = """# MVP Website Implementation
+
+This pull request addresses issue #{issue_number}.
+"""
+
+PR_CHANGES = """
+## Changes Made
+- Created basic Flask application structure
+- Implemented website according to the description
+"""
+
+PR_FAILED_TEMPLATE = PR_HEADER + """
+## Status
+Failed to generate website files based on the description.
+An empty PR is being submitted as a placeholder.
+
+## Description
+{description}
+"""
+
+PR_NOT_RUNNING_TEMPLATE = PR_HEADER + PR_CHANGES + """
+## Status
+Warning: The generated website could not be run successfully.
+Review the code carefully before merging.
+
+## Description
+{description}
+"""
+
+PR_HOSTED_TEMPLATE = PR_HEADER + PR_CHANGES + """
+## Description
+{description}
+
+## Hosted Website
+The website is hosted at: {url}
+"""
+
 # Define request model
 class WebsiteRequest(BaseModel):
     repo_url: str
     website_description: str
     public_access: Optional[bool] = False
+    use_batch_api: Optional[bool] = False
 
 # Initialize FastAPI app
 app = FastAPI(title="Website Builder API")
 
+# Builds currently running, so identical concurrent requests share one result
+_inflight_builds = {}
+_inflight_lock = threading.Lock()
+
+def build_website_once(repo_url, website_description, public_access=False, use_batch_api=False, defer=None):
+    """Run build_website, joining an identical build that is already in flight instead of starting another."""
+    key = (repo_url, hashlib.sha256(website_description.encode("utf-8")).hexdigest(), bool(public_access), bool(use_batch_api))
+    with _inflight_lock:
+        future = _inflight_builds.get(key)
+        is_leader = future is None
+        if is_leader:
+            future = _inflight_builds[key] = Future()
+    
+    if not is_leader:
+        return future.result()
+    
+    try:
+        future.set_result(build_website(repo_url, website_description, public_access, use_batch_api, defer))
+    except Exception as e:
+        future.set_exception(e)
+    finally:
+        with _inflight_lock:
+            _inflight_builds.pop(key, None)
+    return future.result()
+
 @app.post("/build_website")
-async def api_build_website(request: WebsiteRequest):
+def api_build_website(request: WebsiteRequest, background_tasks: BackgroundTasks):
     """API endpoint to build an MVP website from GitHub repo and description."""
     try:
-        return build_website(request.repo_url, request.website_description, request.public_access)
+        # Sandbox teardown runs after the response has been sent
+        return build_website_once(
+            request.repo_url, request.website_description, request.public_access, request.use_batch_api,
+            defer=background_tasks.add_task
+        )
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
-def download_files_from_sandbox(sandbox, remote_dir, local_dir):
-    # List all entries in the current directory
-    entries = sandbox.files.list(remote_dir)
+class ChunkReader(io.RawIOBase):
+    """Read-only file object over an iterator of byte chunks."""
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._buffer = b""
     
-    for entry in entries:
-        # Get the path from the EntryInfo object
-        file_path = entry.path  # Using path attribute of EntryInfo object
-        
-        if entry.name.startswith('.'):
-            continue
+    def readable(self):
+        return True
+    
+    def readinto(self, b):
+        while not self._buffer:
+            try:
+                self._buffer = next(self._chunks)
+            except StopIteration:
+                return 0
+        size = min(len(b), len(self._buffer))
+        b[:size] = self._buffer[:size]
+        self._buffer = self._buffer[size:]
+        return size
+
+def iter_files_from_sandbox(sandbox, remote_dir):
+    """Stream a sandbox directory as a single tar archive, yielding its files as (path, mode, content).
+    
+    Members are decompressed and handed on one at a time, so the archive is never held in memory.
+    Any failure is raised as OSError so the consumer can abort instead of committing a partial tree.
+    """
+    try:
+        # Pack everything except hidden entries and bytecode caches in one command
+        sandbox.commands.run(
+            f"tar -czf {SANDBOX_ARCHIVE_PATH} -C {remote_dir} --exclude='*/.*' --exclude=__pycache__ ."
+        )
+        stream = io.BufferedReader(ChunkReader(sandbox.files.read(SANDBOX_ARCHIVE_PATH, format="stream")))
+        with tarfile.open(fileobj=stream, mode="r|gz") as tar:
+            for member in tar:
+                if not member.isfile():
+                    continue
+                # Keep the executable bit; git only tracks 644 and 755 files
+                mode = 0o100755 if member.mode & 0o111 else 0o100644
+                yield os.path.normpath(member.name), mode, tar.extractfile(member).read()
+    except Exception as e:
+        raise OSError(f"Error downloading files from {remote_dir}: {e}") from e
 
-        if entry.name == '__pycache__':
-            continue
+async def prepare_build(repo, repo_url, issue_title, issue_body, website_description, public_access=False, use_batch_api=False):
+    """Create the issue, build the website and refresh the repository mirror concurrently.
+    
+    Returns (issue, (sandbox, website_info), push_url).
+    """
+    async def generate_and_run():
+        sandbox = await agenerate_website_in_sandbox(website_description, use_batch_api=use_batch_api)
+        if not sandbox:
+            return None, None
+        # Run the website in sandbox if generation was successful
+        website_info = await asyncio.to_thread(run_website_in_sandbox, sandbox, public_access=public_access)
+        return sandbox, website_info
+    
+    results = await asyncio.gather(
+        asyncio.to_thread(create_issue, repo, issue_title, issue_body),
+        generate_and_run(),
+        asyncio.to_thread(prepare_mirror, repo_url, use_fork=True, with_mirror=not PUSH_VIA_API),
+        return_exceptions=True
+    )
+    
+    # If any stage raised, don't leave the sandbox the others may have started behind
+    errors = [result for result in results if isinstance(result, BaseException)]
+    if errors:
+        if not isinstance(results[1], BaseException):
+            sandbox, website_info = results[1]
+            if website_info:
+                await asyncio.to_thread(stop_website_server, website_info)
+            elif sandbox:
+                await asyncio.to_thread(release_sandbox, sandbox)
+        raise errors[0]
+    return results
 
-        if not file_path.startswith(remote_dir):
-            continue
-        
-        # Handle both directories and files
-        if entry.type == FileType.DIR:
-            # Create the corresponding local directory
-            relative_path = os.path.relpath(file_path, remote_dir)
-            new_local_dir = os.path.join(local_dir, relative_path)
-            os.makedirs(new_local_dir, exist_ok=True)
-            # Recursively download files from this directory
-            download_files_from_sandbox(sandbox, file_path, new_local_dir)
-        else:
-            print(f"Downloading file: {entry.name}")
-            
-            # Calculate the relative path and create proper local path
-            relative_path = os.path.relpath(file_path, remote_dir)
-            local_path = os.path.join(local_dir, relative_path)
-            
-            # Create directory if needed
-            os.makedirs(os.path.dirname(local_path), exist_ok=True)
-            
-            try:
-                # Download file content
-                content = sandbox.files.read(file_path)
-                with open(local_path, 'wb') as f:
-                    # Write as binary to handle all file types
-                    if isinstance(content, str):
-                        f.write(content.encode('utf-8'))
-                    else:
-                        f.write(content)
-            except Exception as e:
-                print(f"Error downloading {file_path}: {e}")
-
-def build_website(repo_url, website_description, public_access=False):
+def build_website(repo_url, website_description, public_access=False, use_batch_api=False, defer=None):
     """
     Main function to build an MVP website from a GitHub repo and description.
+    With use_batch_api, files are generated through the cheaper but slower OpenAI Batch API.
+    If defer is given (e.g. BackgroundTasks.add_task), sandbox teardown is handed to it
+    instead of running before the function returns.
     
     Steps:
-    1. Clone the repository
-    2. Create an issue
-    3. Create a new branch
-    4. Generate website in sandbox
-    5. Run website in sandbox
-    6. Commit and push changes
-    7. Create a pull request
+    1. Create an issue, generate and run the website in a sandbox, and refresh
+       the local mirror of the repository (concurrently)
+    2. Commit the generated files on a new branch and push it
+    3. Create a pull request
     """
     try:
         # Parse the repository URL to get owner and repo name
@@ -110,119 +227,74 @@ def build_website(repo_url, website_description, public_access=False):
 
         # Create an issue
         issue_title = "Build MVP Website"
-        issue_body = f"""
-        # Build MVP Website
-
-        ## Description
-        {website_description}
-
-        ## Requirements
-        - Create a simple Flask app
-        - Implement the website according to the description
-        """
-
-        issue = create_issue(repo, issue_title, issue_body)
+        issue_body = ISSUE_BODY_TEMPLATE.format(description=website_description)
+
+        # Create the issue, generate and run the website, and refresh the repository mirror concurrently
+        issue, (sandbox, website_info), push_url = run_async(prepare_build(
+            repo, repo_url, issue_title, issue_body,
+            website_description, public_access, use_batch_api
+        ))
+        generate_success = sandbox is not None
+        run_success = website_info is not None
+        
+        def teardown(func, *args):
+            if defer:
+                defer(func, *args)
+            else:
+                func(*args)
+        
+        def stop_website():
+            if website_info:
+                teardown(stop_website_server, website_info)
+        
+        def cleanup():
+            if website_info:
+                stop_website()
+            elif sandbox:
+                teardown(release_sandbox, sandbox)
+        
         if not issue:
+            cleanup()
             return {"success": False, "message": "Failed to create issue"}
-
-        # Create a new branch
-        branch_name = f"feature/mvp-website-{issue.number}"
         
-        # Initialize variables
-        sandbox = None
-        website_info = None
-        generate_success = False
-        run_success = False
+        if not push_url:
+            cleanup()
+            return {"success": False, "message": "Failed to clone repository"}
         
-        # Generate website in sandbox
-        sandbox = generate_website_in_sandbox(website_description)
-        if sandbox:
-            generate_success = True
-            # Run the website in sandbox if generation was successful
-            website_info = run_website_in_sandbox(sandbox, public_access=public_access)
-            if website_info:
-                run_success = True
+        # Stream files from sandbox straight into the commit if generation was successful
+        files = iter_files_from_sandbox(sandbox, '/home/user') if generate_success else []
         
-        # Clone the repository to temporary directory and create branch
-        with tempfile.TemporaryDirectory() as temp_dir:
-            # Use the updated clone_repository function with fork=True (default)
-            if not clone_repository(repo_url, temp_dir, use_fork=True):
-                if website_info:
-                    stop_website_server(website_info)
-                return {"success": False, "message": "Failed to clone repository"}
-                
-            if not create_branch(temp_dir, branch_name):
-                if website_info:
-                    stop_website_server(website_info)
-                return {"success": False, "message": "Failed to create branch"}
-            
-            # Download files from sandbox to temp directory if generation was successful
-            if generate_success:
-                download_files_from_sandbox(sandbox, '/home/user', temp_dir)
-            
-            # Commit and push changes
-            commit_message = f"Create MVP website for #{issue.number}"
-            if not commit_and_push_changes(temp_dir, commit_message):
-                if website_info:
-                    stop_website_server(website_info)
-                return {"success": False, "message": "Failed to commit and push changes"}
-
-            # Create a pull request
-            pr_title = f"Fixes #{issue.number}: {issue_title}"
-            
-            # Adjust PR body based on success/failure of generation and running
-            if not generate_success:
-                pr_body = f"""
-                # MVP Website Implementation
-
-                This pull request addresses issue #{issue.number}.
-
-                ## Status
-                Failed to generate website files based on the description.
-                An empty PR is being submitted as a placeholder.
-
-                ## Description
-                {website_description}
-                """
-            elif not run_success:
-                pr_body = f"""
-                # MVP Website Implementation
-
-                This pull request addresses issue #{issue.number}.
-
-                ## Changes Made
-                - Created basic Flask application structure
-                - Implemented website according to the description
-
-                ## Status
-                Warning: The generated website could not be run successfully.
-                Review the code carefully before merging.
-
-                ## Description
-                {website_description}
-                """
-            else:
-                pr_body = f"""
-                # MVP Website Implementation
-
-                This pull request addresses issue #{issue.number}.
-
-                ## Changes Made
-                - Created basic Flask application structure
-                - Implemented website according to the description
-
-                ## Description
-                {website_description}
+        # Commit the files on a new branch and push it, without a local working copy
+        branch_name = f"feature/mvp-website-{issue.number}"
+        commit_message = f"Create MVP website for #{issue.number}"
+        commit_files = commit_files_via_api if PUSH_VIA_API else commit_files_to_branch
+        committed = commit_files(push_url, branch_name, files, commit_message)
+        
+        # Nothing is served from the sandbox, so it can go back to the pool
+        if generate_success and not run_success:
+            teardown(release_sandbox, sandbox)
+        
+        if not committed:
+            stop_website()
+            return {"success": False, "message": "Failed to commit and push changes"}
 
-                ## Hosted Website
-                The website is hosted at: {website_info["url"]}
-                """
+        # Create a pull request
+        pr_title = f"Fixes #{issue.number}: {issue_title}"
+        
+        # Adjust PR body based on success/failure of generation and running
+        if not generate_success:
+            pr_body = PR_FAILED_TEMPLATE.format(issue_number=issue.number, description=website_description)
+        elif not run_success:
+            pr_body = PR_NOT_RUNNING_TEMPLATE.format(issue_number=issue.number, description=website_description)
+        else:
+            pr_body = PR_HOSTED_TEMPLATE.format(
+                issue_number=issue.number, description=website_description, url=website_info["url"]
+            )
 
-            pull_request = create_pull_request(repo, branch_name, "main", pr_title, pr_body)
-            if not pull_request:
-                if website_info:
-                    stop_website_server(website_info)
-                return {"success": False, "message": "Failed to create pull request"}
+        pull_request = create_pull_request(repo, branch_name, "main", pr_title, pr_body)
+        if not pull_request:
+            stop_website()
+            return {"success": False, "message": "Failed to create pull request"}
 
         # Include appropriate details in the response based on what succeeded
         response = {
@@ -248,8 +320,11 @@ def build_website(repo_url, website_description, public_access=False):
 
 
 if __name__ == "__main__":
-    # Run the FastAPI server using uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    # Run the FastAPI server using uvicorn; each worker process keeps its own sandbox pool and only
+    # coalesces identical builds within itself, while repository mirrors are shared under a file lock.
+    # uvicorn picks uvloop and httptools automatically when they are installed
+    workers = int(os.getenv("DEPLOYBOT_WORKERS", os.getenv("WEB_CONCURRENCY", "1")))
+    uvicorn.run("main:app", host="0.0.0.0", port=8000, workers=workers)
 
 """
 curl -X POST "http://localhost:8000/build_website" \